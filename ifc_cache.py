@@ -0,0 +1,454 @@
+# ***************************************************************************
+# *                                                                         *
+# *   Copyright (c) 2022 Yorik van Havre <yorik@uncreated.net>              *
+# *                                                                         *
+# *   This program is free software; you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License (GPL)            *
+# *   as published by the Free Software Foundation; either version 3 of     *
+# *   the License, or (at your option) any later version.                   *
+# *   for detail see the LICENCE text file.                                 *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU Library General Public     *
+# *   License along with this program; if not, write to the Free Software   *
+# *   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  *
+# *   USA                                                                   *
+# *                                                                         *
+# ***************************************************************************
+
+
+"""This module contains the geometry caches: The in-memory cache of each IFC
+file, and the persistent cache, which keeps the geometry generated from IFC
+files on disk, so unchanged files can be reopened without computing it again"""
+
+
+import os
+import time
+import pickle
+import hashlib
+import weakref
+import threading
+import collections
+import FreeCAD
+import ifc_tools
+
+PARAMS = FreeCAD.ParamGet("User parameter:BaseApp/Preferences/Mod/NativeIFC")
+VERSION = 3  # increase when the format of the cached data changes
+DISK_CACHES = weakref.WeakKeyDictionary()  # ifcfile: (file stamp, {mode: cache})
+PRUNED = False  # if old cache files have been deleted in this session
+# data slot: companion slot. The "Node" slot holds the unified coin nodes of
+# objects, keyed by (document name, object name), to patch them later
+SLOTS = {"Shape": "Color", "Coin": "Placement", "Node": None}
+
+
+class geometry_cache:
+    """In-memory cache of the geometry generated from one IFC file. Shapes and
+    coin nodes are evicted, least recently used first, when their estimated
+    size exceeds the memory budget, together with their color or placement"""
+
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = PARAMS.GetInt("CacheBudget", 1024) * 1024 * 1024
+        self.budget = budget
+        self.data = {slot: {} for slot in SLOTS}
+        self.data.update({slot: {} for slot in SLOTS.values() if slot})
+        self.usage = collections.OrderedDict()  # (slot, id): data reference
+        self.refs = {}  # data reference: [count, size in bytes, data owner]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = set()  # ids of invalidated elements not generated again yet
+        # background jobs and the GUI thread can use the cache at the same time
+        self.lock = threading.RLock()
+
+    def get(self, slot, eid):
+        """Returns the cached value for the given slot and element id, or None"""
+
+        with self.lock:
+            value = self.data[slot].get(eid)
+            if slot in SLOTS:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self.usage.move_to_end((slot, eid))
+            return value
+
+    def set(self, slot, eid, value, ref=None):
+        """Stores a value for the given slot and element id. A ref can be given
+        if the value shares its data with another value, which doesn't show
+        in the value itself (shapes located at other places, for ex). It is
+        the value that owns the data"""
+
+        with self.lock:
+            if slot in SLOTS:
+                self.discard(slot, eid)
+                self.dirty.discard(eid)
+                # elements with shared geometry use the same data,
+                # which is only counted once
+                owner = get_owner(value) if ref is None else ref
+                # the owner is kept alive, so its id can't be reused by other
+                # data while values still share it
+                ref = id(owner)
+                if ref not in self.refs:
+                    self.refs[ref] = [0, get_size(value), owner]
+                    self.size += self.refs[ref][1]
+                self.refs[ref][0] += 1
+                self.usage[(slot, eid)] = ref
+            self.data[slot][eid] = value
+            while self.size > self.budget and len(self.usage) > 1:
+                slot, eid = next(iter(self.usage))
+                self.discard(slot, eid)
+                self.evictions += 1
+
+    def discard(self, slot, eid):
+        """Removes the value of the given slot and element id"""
+
+        with self.lock:
+            self.data[slot].pop(eid, None)
+            if slot in SLOTS:
+                if SLOTS[slot]:
+                    self.data[SLOTS[slot]].pop(eid, None)
+                ref = self.usage.pop((slot, eid), None)
+                if ref in self.refs:
+                    self.refs[ref][0] -= 1
+                    if not self.refs[ref][0]:
+                        self.size -= self.refs.pop(ref)[1]
+
+    def invalidate(self, eid):
+        """Removes all the cached data of an element"""
+
+        with self.lock:
+            for slot in SLOTS:
+                self.discard(slot, eid)
+            self.dirty.add(eid)
+
+    def has(self, eid):
+        """Tells if a shape or coin node of the given element id is cached"""
+
+        with self.lock:
+            return any([eid in self.data[slot] for slot in SLOTS])
+
+    def relocate(self, eid, placement, delta):
+        """Updates the cached data of an element that has been moved by delta,
+        to the given placement. Its geometry doesn't need to be generated again"""
+
+        with self.lock:
+            if eid in self.data["Coin"]:
+                # coin nodes are cached without their placement
+                self.data["Placement"][eid] = placement
+            shape = self.data["Shape"].get(eid)
+            if shape is not None:
+                # the moved shape shares its topology with the cached one
+                self.data["Shape"][eid] = shape.moved(delta)
+
+    def clear(self):
+        """Removes all the cached data"""
+
+        with self.lock:
+            for data in self.data.values():
+                data.clear()
+            self.usage.clear()
+            self.refs.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns a dictionary with usage statistics of this cache"""
+
+        with self.lock:
+            return {
+                "Entries": len(self.usage),
+                "Size": self.size,
+                "Budget": self.budget,
+                "Hits": self.hits,
+                "Misses": self.misses,
+                "Evictions": self.evictions,
+            }
+
+
+def get_owner(value):
+    """Returns the object that owns the data held by a shape or coin node"""
+
+    if isinstance(value, list):
+        # coin nodes sharing their verts array share all their data
+        return value[1]
+    return value
+
+
+def get_size(value):
+    """Returns an estimation of the memory used by a shape or coin node, in bytes"""
+
+    if hasattr(value, "MemSize"):
+        return value.MemSize
+    size = 0
+    for data in value:
+        if hasattr(data, "nbytes"):
+            size += data.nbytes
+        elif isinstance(data, list):
+            # a list of 3-float tuples takes about 136 bytes per item,
+            # a list of ints about 36 bytes
+            if data and isinstance(data[0], tuple):
+                size += 136 * len(data)
+            else:
+                size += 36 * len(data)
+    return size
+
+
+def get_cache(ifcfile):
+    """Returns the in-memory geometry cache associated with this ifc file"""
+
+    project = ifc_tools.get_project(ifcfile)
+    proxy = getattr(project, "Proxy", None)
+    cache = getattr(proxy, "ifccache", None)
+    if not isinstance(cache, geometry_cache):
+        cache = geometry_cache()
+        if proxy:
+            proxy.ifccache = cache
+    return cache
+
+
+def find_cache(ifcfile):
+    """Returns the in-memory geometry cache of an ifc file, if it exists"""
+
+    proxy = getattr(ifc_tools.get_project(ifcfile), "Proxy", None)
+    cache = getattr(proxy, "ifccache", None)
+    if isinstance(cache, geometry_cache):
+        return cache
+    return None
+
+
+def invalidate(ifcfile, eids):
+    """Removes the cached geometry of the given element ids of an ifc file"""
+
+    cache = find_cache(ifcfile)
+    if cache:
+        for eid in eids:
+            cache.invalidate(eid)
+
+
+def get_placements(ifcfile, eids):
+    """Returns a {element id: placement} dictionary of the given element ids
+    that have cached geometry, to relocate it once they have been moved"""
+
+    import ifc_generator  # lazy import
+
+    cache = find_cache(ifcfile)
+    if not cache:
+        return {}
+    return {
+        eid: ifc_generator.get_placement(ifcfile[eid])
+        for eid in eids
+        if cache.has(eid)
+    }
+
+
+def relocate(ifcfile, placements):
+    """Moves the cached geometry of elements of an ifc file. placements is a
+    {element id: placement before the move} dictionary"""
+
+    import ifc_generator  # lazy import
+
+    cache = find_cache(ifcfile)
+    if not cache:
+        return
+    for eid, old in placements.items():
+        new = ifc_generator.get_placement(ifcfile[eid])
+        cache.relocate(eid, new, new.multiply(old.inverse()))
+
+
+class disk_cache:
+    """Stores geometry data of the products of one IFC file in one file on disk.
+    Entries are keyed by product id and the contents of its representation and
+    placement, so modified products never get outdated data"""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.changed = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Reads the cache file, if not done yet"""
+
+        with self.lock:
+            if self.data is None:
+                self.data = {}
+                if os.path.exists(self.path):
+                    try:
+                        with open(self.path, "rb") as f:
+                            version, data = pickle.load(f)
+                        if version == VERSION:
+                            self.data = data
+                        # recently used files are kept when pruning
+                        os.utime(self.path)
+                    except Exception:
+                        FreeCAD.Console.PrintWarning(
+                            "IFC: Unable to read cache file " + self.path + "\n"
+                        )
+            return self.data
+
+    def get(self, key):
+        """Returns the cached data of the element with the given key (see
+        get_element_key), or None"""
+
+        with self.lock:
+            return self.load().get(key)
+
+    def set(self, key, value):
+        """Stores the data of the element with the given key"""
+
+        with self.lock:
+            self.load()[key] = value
+            self.changed = True
+
+    def save(self):
+        """Writes the cache file to disk, if it has changed"""
+
+        with self.lock:
+            if not self.changed:
+                return
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump((VERSION, self.data), f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, self.path)
+                self.changed = False
+            except Exception:
+                FreeCAD.Console.PrintWarning(
+                    "IFC: Unable to write cache file " + self.path + "\n"
+                )
+
+
+def save_disk_caches():
+    """Writes the disk caches that have changed to disk. Generated geometry is
+    only added to the caches in memory, so this is done once after recomputing
+    instead of once per generated object"""
+
+    for stamp, caches in list(DISK_CACHES.values()):
+        for cache in list(caches.values()):
+            if isinstance(cache, disk_cache):
+                cache.save()
+
+
+def get_disk_cache(ifcfile, mode):
+    """Returns the disk cache of the given ifcfile for the given mode
+    ("Shape" or "Coin"), or None if the file cannot be cached"""
+
+    if not PARAMS.GetBool("DiskCache", True):
+        return None
+    if PARAMS.GetBool("ClearDiskCache", False):
+        # requested from the preferences
+        PARAMS.SetBool("ClearDiskCache", False)
+        clear_disk_cache()
+    project = ifc_tools.get_project(ifcfile)
+    if getattr(project, "Modified", False):
+        # the contents of the file on disk don't match anymore
+        return None
+    path = getattr(project, "IfcFilePath", None)
+    if not path or not os.path.exists(path):
+        return None
+    stamp = (path, os.path.getmtime(path), os.path.getsize(path))
+    if ifcfile in DISK_CACHES and DISK_CACHES[ifcfile][0] == stamp:
+        caches = DISK_CACHES[ifcfile][1]
+    else:
+        caches = {}
+        DISK_CACHES[ifcfile] = (stamp, caches)
+    # geometry generated with other settings is stored separately
+    options = "{}.{}.{:g}".format(
+        mode.lower(),
+        int(PARAMS.GetBool("SubtractOpenings", True)),
+        PARAMS.GetFloat("Deflection", 1.0) if mode == "Coin" else 0,
+    )
+    if options not in caches:
+        if "Hash" not in caches:
+            caches["Hash"] = get_file_hash(path)
+        name = caches["Hash"] + "." + options
+        caches[options] = disk_cache(os.path.join(get_cache_dir(), name))
+    return caches[options]
+
+
+def get_cache_dir():
+    """Returns the directory where cache files are stored"""
+
+    global PRUNED
+
+    path = os.path.join(FreeCAD.getUserCachePath(), "NativeIFC")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if not PRUNED:
+        PRUNED = True
+        prune_disk_cache(path)
+    return path
+
+
+def prune_disk_cache(path):
+    """Deletes the cache files of the given directory that haven't been used
+    for the number of days set in the preferences, then the least recently
+    used ones until the files fit in the size set in the preferences"""
+
+    days = PARAMS.GetInt("DiskCacheDays", 30)
+    budget = PARAMS.GetInt("DiskCacheSize", 2048) * 1024 * 1024
+    files = []
+    for name in os.listdir(path):
+        f = os.path.join(path, name)
+        try:
+            stat = os.stat(f)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, f))
+    # most recently used first
+    files.sort(reverse=True)
+    limit = time.time() - days * 86400
+    total = 0
+    for mtime, size, f in files:
+        if mtime < limit or total + size > budget:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        else:
+            total += size
+
+
+def get_file_hash(path):
+    """Returns a hash of the contents of the given file"""
+
+    stime = time.time()
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    FreeCAD.Console.PrintLog(
+        "IFC: Hashed {} in {:.2f}s\n".format(path, time.time() - stime)
+    )
+    return digest.hexdigest()
+
+
+def get_element_key(element):
+    """Returns a key identifying the geometry of the given element"""
+
+    ifcfile = ifc_tools.get_element_file(element)
+    digest = hashlib.sha1()
+    for attr in ("Representation", "ObjectPlacement"):
+        value = getattr(element, attr, None)
+        if value:
+            for entity in ifcfile.traverse(value):
+                digest.update(str(entity).encode("utf8"))
+    return (element.id(), ifc_tools.SCALE, digest.hexdigest())
+
+
+def clear_disk_cache():
+    """Deletes all the cache files from disk"""
+
+    path = get_cache_dir()
+    for f in os.listdir(path):
+        try:
+            os.remove(os.path.join(path, f))
+        except OSError:
+            pass
+    DISK_CACHES.clear()
@@ -25,16 +25,52 @@ The only entry point in this module is the generate_geometry() function which is
 used by the execute() method of ifc_objects"""
 
 
+import os
+import sys
 import time
+import queue
+import weakref
+import threading
+import collections
+import numpy
 import FreeCAD
 from FreeCAD import Base
 import Part
 import ifcopenshell
+import ifcopenshell.util.element
+import ifcopenshell.util.placement
 import ifc_tools
+import ifc_cache
 import multiprocessing
 import FreeCADGui
 from pivy import coin
 
+# classes that are never rendered, with all their subtypes
+UNRENDERED_CLASSES = (
+    "IfcFeatureElement",
+    "IfcOpeningElement",
+    "IfcSpace",
+    "IfcFurnishingElement",
+    "IfcAnnotation",
+)
+GEOM_SERVICES = weakref.WeakKeyDictionary()  # ifcfile: geom_service
+POOL_MINIMUM = 100  # minimum number of elements to use worker processes
+BACKGROUND_MINIMUM = 100  # minimum number of elements to use a background job
+JOBS = {}  # (document name, object name): coin_job
+WORKERS = weakref.WeakKeyDictionary()  # ifcfile: job_worker
+NUMPY_FIELDS = None  # if pivy accepts arrays in setValues, None if unknown yet
+# vertex indices of the faces and edges of a box whose vertex i is
+# at (i & 1, (i >> 1) & 1, (i >> 2) & 1)
+BOX_FACES = (
+    (0, 2, 3, 1),
+    (4, 5, 7, 6),
+    (0, 1, 5, 4),
+    (2, 6, 7, 3),
+    (0, 4, 6, 2),
+    (1, 3, 7, 5),
+)
+BOX_EDGES = (0, 1, 2, 3, 4, 5, 6, 7, 0, 2, 1, 3, 4, 6, 5, 7, 0, 4, 1, 5, 2, 6, 3, 7)
+
 
 def generate_geometry(obj, cached=False):
     """Sets the geometry of the given object from a corresponding IFC element.
@@ -73,10 +109,28 @@ def generate_geometry(obj, cached=False):
             obj.Shape = Part.Shape()
             print_debug(obj)
     elif obj.ViewObject and obj.ShapeMode == "Coin":
-        node, placement = generate_coin(ifcfile, elements, cached)
+        key = (obj.Document.Name, obj.Name)
+        if key in JOBS:
+            # a newer result is needed
+            JOBS.pop(key).cancel(superseded=True)
+        elif not cached and patch_coin(obj, ifcfile, elements):
+            # only the modified elements have been regenerated
+            return
+        if len(elements) >= BACKGROUND_MINIMUM and FreeCAD.GuiUp:
+            if ifc_tools.PARAMS.GetBool("BackgroundGeometry", True):
+                # the representation and colors will be set when the job ends
+                JOBS[key] = coin_job(obj, ifcfile, elements, cached)
+                JOBS[key].start()
+                return
+        stream = None
+        if len(elements) > 1 and ifc_tools.PARAMS.GetBool("StreamCoin", True):
+            # show the elements already generated while generating the others
+            stream = coin_stream(obj.ViewObject)
+        node, placement = generate_coin(ifcfile, elements, cached, stream)
+        keep_node(obj, ifcfile, node)
         if node:
             set_representation(obj.ViewObject, node)
-            colors = node[0]
+            ifc_tools.set_colors(obj, node[0])
         else:
             set_representation(obj.ViewObject, None)
             print_debug(obj)
@@ -88,65 +142,152 @@ def generate_geometry(obj, cached=False):
         ifc_tools.set_colors(obj, colors)  # TODO migrate here?
 
 
+def patch_coin(obj, ifcfile, elements):
+    """Regenerates only the elements of an object whose cached geometry has
+    been invalidated, and splices them into the current coin node of the
+    object. Returns False if this is not possible"""
+
+    cache = ifc_cache.get_cache(ifcfile)
+    node = cache.get("Node", (obj.Document.Name, obj.Name))
+    if not node:
+        # never kept, or evicted from the cache
+        return False
+    table = node[5]
+    ids = [e.id() for e in elements if getattr(e, "Representation", None)]
+    if sorted(ids) != sorted(table["ids"]):
+        return False
+    dirty = [i for i in ids if i in cache.dirty]
+    if not dirty:
+        # we don't know what has changed
+        return False
+    coords, fset, eset = get_representation_nodes(obj.ViewObject)
+    index = {eid: i for i, eid in enumerate(table["ids"])}
+    resized = False
+    for eid in dirty:
+        part, placement = generate_coin(ifcfile, [ifcfile[eid]], cached=True)
+        if not part:
+            return False
+        part = apply_placement([part[0][0], part[1], part[2], part[3]], placement)
+        if splice(node, index[eid], part):
+            resized = True
+        elif not resized:
+            # update the coin fields in place
+            vstart, fstart, estart = get_part_offsets(table, index[eid])
+            vend = vstart + len(part[1])
+            fend = fstart + len(part[2])
+            eend = estart + len(part[3])
+            set_field(coords.point, node[1][vstart:vend], vstart)
+            set_field(fset.coordIndex, node[2][fstart:fend], fstart)
+            set_field(eset.coordIndex, node[3][estart:eend], estart)
+    if resized:
+        set_representation(obj.ViewObject, node)
+    ifc_tools.set_colors(obj, node[0])
+    # count the new size of the node
+    keep_node(obj, ifcfile, node)
+    return True
+
+
+def keep_node(obj, ifcfile, node):
+    """Keeps the unified coin node of an object made of several elements in
+    the geometry cache, so patch_coin can splice modified elements into it"""
+
+    cache = ifc_cache.get_cache(ifcfile)
+    key = (obj.Document.Name, obj.Name)
+    if node and len(node) > 5 and len(node[5]["ids"]) > 1:
+        cache.set("Node", key, node)
+    else:
+        cache.discard("Node", key)
+
+
 def generate_shape(ifcfile, elements, cached=False):
-    """Returns a Part shape and a list of colors for a list of elements"""
+    """Returns a Part shape and a list of colors for a list of elements.
+    The shape shares its topology with the cached shapes, so it must be
+    copied before being modified in place"""
 
     # setup
+    # strip out elements without representation, as they can't generate a shape anyway
+    elements = [e for e in elements if getattr(e, "Representation", None)]
     if not elements:
         return None, None
     shapes = []
     colors = []
-    cache = get_cache(ifcfile)
+    cache = ifc_cache.get_cache(ifcfile)
 
     # get cached elements
     if cached:
         rest = []
         for element in elements:
-            if element.id in cache["Shape"]:
-                shape = cache["Shape"][element.id]
-                shapes.append(shape.copy())
-                if element.id in cache["Color"]:
-                    color = cache["Color"][element.id]
+            shape = cache.get("Shape", element.id())
+            if shape:
+                # compounds only reference their subshapes, no copy needed
+                shapes.append(shape)
+                runs = cache.get("Color", element.id())
+                if runs:
+                    colors.extend(expand_colors(runs))
                 else:
-                    color = (0.8, 0.8, 0.8)
-                if len(color) <= 4:
-                    for face in shape.Faces:
-                        colors.append(color)
-                else:
-                    colors = color
+                    colors.extend([(0.8, 0.8, 0.8)] * len(shape.Faces))
             else:
                 rest.append(element)
         if not rest:
             # all elements have been taken from cache, nothing more to do
-            return shapes, colors
+            return make_compound(shapes), colors
         elements = rest
 
-    # prepare the iterator
-    iterator = get_geom_iterator(ifcfile, elements, brep_mode=True)
-    if iterator is None:
-        return None, None
+    # get elements stored on disk
+    disk = ifc_cache.get_disk_cache(ifcfile, "Shape")
+    keys = {}  # element id: disk cache key
+    if disk:
+        rest = []
+        for element in elements:
+            key = keys[element.id()] = ifc_cache.get_element_key(element)
+            data = disk.get(key)
+            if data:
+                shape = Part.Shape()
+                shape.importBrepFromString(data[0], False)
+                cache.set("Shape", element.id(), shape)
+                cache.set("Color", element.id(), data[1])
+                shapes.append(shape)
+                colors.extend(expand_colors(data[1]))
+            else:
+                rest.append(element)
+        if not rest:
+            return make_compound(shapes), colors
+        elements = rest
+
+    # prepare the iterator, or the worker processes. Elements sharing their
+    # geometry with another element reuse the shape of that element
     total = len(elements)
+    elements, followers = get_shared_elements(ifcfile, elements)
+    service = get_geom_service(ifcfile)
+    path = get_pool_path(ifcfile, elements)
+    if path:
+        service.begin(brep_mode=True)
+        items = generate_pooled(ifcfile, elements, path)
+    else:
+        iterator = service.get_iterator(ifcfile, elements, brep_mode=True)
+        if iterator is None:
+            return None, None
+        items = get_brep_items(iterator)
     progressbar = Base.ProgressIndicator()
     progressbar.start("Generating " + str(total) + " shapes...", total)
-    done = []
+    done = set()
 
     # iterate
-    while True:
-        item = iterator.get()
-        if item and item.id not in done:
-            done.append(item.id)
+    for eid, brep, matrix, sstyle, transformed in items:
+        if eid not in done:
+            done.add(eid)
             # get and transfer brep data
-            brep = item.geometry.brep_data
             shape = Part.Shape()
             shape.importBrepFromString(brep, False)
-            mat = ifc_tools.get_freecad_matrix(item.transformation.matrix.data)
-            shape.scale(ifc_tools.SCALE)
-            shape.transformShape(mat)
+            if not transformed:
+                mat = ifc_tools.get_freecad_matrix(matrix)
+                shape.scale(ifc_tools.SCALE)
+                shape.transformShape(mat)
             shapes.append(shape)
 
-            # get colors
-            sstyle = item.geometry.surface_styles
-            scolors = []
+            # get colors, as (color, number of faces) runs
+            runs = []
+            color = (sstyle[0], sstyle[1], sstyle[2], 1.0 - sstyle[3])
             if (
                 (len(sstyle) > 4)
                 and len(shape.Solids) > 1
@@ -154,49 +295,167 @@ def generate_shape(ifcfile, elements, cached=False):
             ):
                 # multiple colors
                 for i in range(len(shape.Solids)):
-                    for j in range(len(shape.Solids[i].Faces)):
-                        scolors.append(
-                            (
-                                sstyle[i * 4],
-                                sstyle[i * 4 + 1],
-                                sstyle[i * 4 + 2],
-                                1.0 - sstyle[i * 4 + 3],
-                            )
-                        )
-                if len(colors) < len(shape.Faces):
-                    for i in range(len(shape.Faces) - len(colors)):
-                        scolors.append(
-                            (sstyle[0], sstyle[1], sstyle[2], 1.0 - sstyle[3])
-                        )
+                    scolor = (
+                        sstyle[i * 4],
+                        sstyle[i * 4 + 1],
+                        sstyle[i * 4 + 2],
+                        1.0 - sstyle[i * 4 + 3],
+                    )
+                    runs.append((scolor, len(shape.Solids[i].Faces)))
+                rest = len(shape.Faces) - sum([run[1] for run in runs])
+                if rest > 0:
+                    runs.append((color, rest))
             else:
-                color = (sstyle[0], sstyle[1], sstyle[2], 1.0 - sstyle[3])
-                for f in shape.Faces:
-                    scolors.append(color)
+                runs.append((color, len(shape.Faces)))
 
             # update the cache
-            cache["Shape"][item.id] = shape
-            cache["Color"][item.id] = scolors
-            colors.extend(scolors)
+            cache.set("Shape", eid, shape)
+            cache.set("Color", eid, runs)
+            if disk:
+                disk.set(keys[eid], (shape.exportBrepToString(), runs))
+            colors.extend(expand_colors(runs))
             progressbar.next(True)
+
+            # shared geometry, as located references to the same topology
+            if eid in followers:
+                inverse = get_placement(ifcfile[eid]).inverse()
+                for follower in followers[eid]:
+                    fshape = shape.moved(get_placement(follower).multiply(inverse))
+                    cache.set("Shape", follower.id(), fshape, ref=shape)
+                    cache.set("Color", follower.id(), runs)
+                    if disk:
+                        key = keys[follower.id()]
+                        disk.set(key, (fshape.exportBrepToString(), runs))
+                    shapes.append(fshape)
+                    colors.extend(expand_colors(runs))
+                    progressbar.next(True)
+
+    service.report(len(done))
+    progressbar.stop()
+    return make_compound(shapes), colors
+
+
+def expand_colors(runs):
+    """Returns a list of colors, one per face, from (color, number of faces)
+    runs. The same color tuple is shared by all the faces of a run"""
+
+    colors = []
+    for color, count in runs:
+        colors.extend([color] * count)
+    return colors
+
+
+def get_brep_items(iterator):
+    """Yields (id, brep, matrix, styles, transformed) tuples from a geometry
+    iterator in brep mode"""
+
+    while True:
+        item = iterator.get()
+        if item:
+            geom = item.geometry
+            matrix = item.transformation.matrix.data
+            yield item.id, geom.brep_data, matrix, geom.surface_styles, False
         if not iterator.next():
             break
 
-    # write the cache
-    set_cache(ifcfile, cache)
 
-    # compound the shape if needed
-    if len(shapes) == 1:
-        shape = shapes[0]
-    else:
-        shape = Part.makeCompound(shapes)
+def get_pool_path(ifcfile, elements):
+    """Returns the path of the given ifcfile if the BREP data of the given
+    elements should be generated by worker processes, otherwise None"""
 
-    progressbar.stop()
-    return shape, colors
+    if not ifc_tools.PARAMS.GetBool("ParallelShapes", False):
+        return None
+    if len(elements) < POOL_MINIMUM:
+        return None
+    project = ifc_tools.get_project(ifcfile)
+    if getattr(project, "Modified", True):
+        # workers read the file from disk, which must be up to date
+        return None
+    path = getattr(project, "IfcFilePath", None)
+    if not path or not os.path.exists(path):
+        return None
+    if not get_python_executable():
+        return None
+    return path
+
+
+def get_python_executable():
+    """Returns the path to a Python interpreter that can run worker processes"""
+
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    # inside FreeCAD, sys.executable is the FreeCAD executable
+    for folder in (os.path.dirname(sys.executable), os.path.join(sys.prefix, "bin")):
+        for name in ("python3", "python", "python.exe"):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def generate_pooled(ifcfile, elements, path):
+    """Generates the BREP data of the given elements in worker processes. Yields
+    (id, brep, matrix, styles, transformed) tuples as the workers finish. Elements
+    of failed workers are generated in this process"""
+
+    import concurrent.futures  # lazy import
+    import ifc_workers
+
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(get_python_executable())
+    workers = get_cores()
+    ids = [e.id() for e in elements]
+    size = -(-len(ids) // (workers * 4))  # a few chunks per worker
+    chunks = [ids[i : i + size] for i in range(0, len(ids), size)]
+    contexts = ifc_tools.get_body_context_ids(ifcfile)
+    openings = ifc_tools.PARAMS.GetBool("SubtractOpenings", True)
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(
+        workers,
+        mp_context=context,
+        initializer=ifc_workers.open_file,
+        initargs=(path,),
+    ) as pool:
+        futures = {}
+        for chunk in chunks:
+            future = pool.submit(
+                ifc_workers.generate_breps,
+                chunk,
+                contexts,
+                openings,
+                ifc_tools.SCALE,
+            )
+            futures[future] = chunk
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                message = "IFC: Worker process failed: {}\n".format(e)
+                FreeCAD.Console.PrintWarning(message)
+                failed.extend(futures[future])
+                continue
+            for result in results:
+                yield result
+    if failed:
+        rest = [ifcfile[i] for i in failed]
+        iterator = get_geom_service(ifcfile).get_iterator(ifcfile, rest, True)
+        if iterator:
+            for result in get_brep_items(iterator):
+                yield result
+
+
+def make_compound(shapes):
+    """Compounds the given shapes if needed"""
 
+    if len(shapes) == 1:
+        return shapes[0]
+    return Part.makeCompound(shapes)
 
-def generate_coin(ifcfile, elements, cached=False):
+
+def generate_coin(ifcfile, elements, cached=False, stream=None):
     """Returns coin node data (verts,face and edge index) and a Placement
-    from a list of ifc elements"""
+    from a list of ifc elements. If a coin_stream is given, the nodes are
+    also sent to it while they get generated"""
 
     # setup
     # strip out elements without representation, as they can't generate a node anyway
@@ -206,43 +465,78 @@ def generate_coin(ifcfile, elements, cached=False):
     # if we have more than one element, placements will need to be applied on subnodes
     grouping = bool(len(elements) > 1)
     nodes = []
+    placements = []
+    ids = []
 
     # process cached elements
     placement = None
-    cache = get_cache(ifcfile)
+    if stream and stream.background:
+        # the project properties can only be read in the GUI thread
+        cache, disk = stream.cache, stream.disk
+    else:
+        cache = ifc_cache.get_cache(ifcfile)
+        disk = ifc_cache.get_disk_cache(ifcfile, "Coin")
     if cached:
         rest = []
         for element in elements:
-            if element.id() in cache["Placement"]:
-                placement = cache["Placement"][element.id()]
-            if element.id() in cache["Coin"]:
-                node = cache["Coin"][element.id()]
-                if grouping:
-                    node = apply_placement(node, placement)
+            node = cache.get("Coin", element.id())
+            if node:
+                placement = cache.get("Placement", element.id())
                 nodes.append(node)
+                placements.append(placement)
+                ids.append(element.id())
             else:
                 rest.append(element)
         if grouping:
             placement = None
         if not rest:
             # all elements have been taken from cache, nothing more to do
-            return unify(nodes), placement
+            return unify(nodes, placements if grouping else None, ids), placement
         elements = rest
 
-    # prepare the iterator
-    iterator = get_geom_iterator(ifcfile, elements, brep_mode=False)
+    # get elements stored on disk
+    keys = {}  # element id: disk cache key
+    if disk:
+        rest = []
+        for element in elements:
+            key = keys[element.id()] = ifc_cache.get_element_key(element)
+            data = disk.get(key)
+            if data:
+                node = list(data[:4])
+                placement = FreeCAD.Placement(FreeCAD.Matrix(*data[4]))
+                cache.set("Coin", element.id(), node)
+                cache.set("Placement", element.id(), placement)
+                nodes.append(node)
+                placements.append(placement)
+                ids.append(element.id())
+            else:
+                rest.append(element)
+        if grouping:
+            placement = None
+        if not rest:
+            return unify(nodes, placements if grouping else None, ids), placement
+        elements = rest
+
+    # prepare the iterator. Elements sharing their geometry with another
+    # element are not tessellated but reuse the data of that element
+    total = len(elements)
+    elements, followers = get_shared_elements(ifcfile, elements)
+    service = get_geom_service(ifcfile)
+    iterator = service.get_iterator(ifcfile, elements, brep_mode=False)
     if iterator is None:
         return None, None
-    total = len(elements)
-    progressbar = Base.ProgressIndicator()
+    progressbar = get_progressbar(stream)
     progressbar.start("Generating " + str(total) + " shapes...", total)
-    done = []
+    done = set()
 
     # iterate
     while True:
+        if stream and stream.cancelled:
+            # keep what has been generated so far
+            break
         item = iterator.get()
         if item and item.id not in done:
-            done.append(item.id)
+            done.add(item.id)
 
             # colors
             if item.geometry.materials:
@@ -257,46 +551,52 @@ def generate_coin(ifcfile, elements, cached=False):
             # verts
             matrix = ifc_tools.get_freecad_matrix(item.transformation.matrix.data)
             placement = FreeCAD.Placement(matrix)
-            verts = item.geometry.verts
-            verts = [FreeCAD.Vector(verts[i : i + 3]) for i in range(0, len(verts), 3)]
-            verts = [tuple(v.multiply(ifc_tools.SCALE)) for v in verts]
-
-            # faces
-            faces = list(item.geometry.faces)
-            faces = [
-                f for i in range(0, len(faces), 3) for f in faces[i : i + 3] + [-1]
-            ]
-
-            # edges
-            edges = list(item.geometry.edges)
-            edges = [
-                e for i in range(0, len(edges), 2) for e in edges[i : i + 2] + [-1]
-            ]
+            verts = numpy.array(item.geometry.verts, dtype=numpy.float64)
+            verts = (verts.reshape(-1, 3) * ifc_tools.SCALE).astype(numpy.float32)
+
+            # faces and edges
+            faces = delimit(item.geometry.faces, 3)
+            edges = delimit(item.geometry.edges, 2)
 
             # update cache
             node = [color, verts, faces, edges]
-            cache["Coin"][item.id] = node
-            cache["Placement"][item.id] = placement
+            cache.set("Coin", item.id, node)
+            cache.set("Placement", item.id, placement)
+            if disk:
+                matrix = tuple(placement.toMatrix().A)
+                disk.set(keys[item.id], (color, verts, faces, edges, matrix))
 
-            if grouping:
-                # if we are joining nodes together, their placement
-                # must be baked in
-                node = apply_placement(node, placement)
             nodes.append(node)
+            placements.append(placement)
+            ids.append(item.id)
             progressbar.next(True)
+
+            # shared geometry
+            for follower in followers.get(item.id, []):
+                fplacement = get_placement(follower)
+                cache.set("Coin", follower.id(), node)
+                cache.set("Placement", follower.id(), fplacement)
+                if disk:
+                    matrix = tuple(fplacement.toMatrix().A)
+                    disk.set(keys[follower.id()], (color, verts, faces, edges, matrix))
+                nodes.append(node)
+                placements.append(fplacement)
+                ids.append(follower.id())
+                progressbar.next(True)
+            if stream:
+                stream.push(nodes, placements if grouping else None)
         if not iterator.next():
             break
 
-    # unify nodes
-    nodes = unify(nodes)
+    # unify nodes. If we are joining nodes together,
+    # their placement must be baked in
+    nodes = unify(nodes, placements if grouping else None, ids)
 
     # nullify placement if already applied
     if grouping:
         placement = None
 
-    # write cache
-    set_cache(ifcfile, cache)
-
+    service.report(len(done))
     progressbar.stop()
     return nodes, placement
 
@@ -305,50 +605,106 @@ def get_decomposition(obj):
     """Gets the elements we need to render this object"""
 
     # stime = time.time()
-    obj_ids = [c.StepId for c in obj.OutListRecursive if hasattr(c, "StepId")]
     element = ifc_tools.get_ifc_element(obj)
     elements = get_decomposed_elements(element, obj)
+    # elements that have their own object render themselves
+    ifcfile = ifc_tools.get_ifcfile(obj)
+    obj_ids = set(ifc_tools.get_registry(ifcfile)["StepId"])
+    obj_ids.discard(element.id())
     elements = filter_types(elements, obj_ids)
     # print("decomposition:", "%02d:%02d" % (divmod(round(time.time() - stime, 1), 60)))
     return elements
 
 
-def filter_types(elements, obj_ids=[]):
+def filter_types(elements, obj_ids=[], exclude=UNRENDERED_CLASSES):
     """Remove unrenderable (for now) elements from the given list"""
 
-    elements = [e for e in elements if e.is_a("IfcProduct")]
-    elements = [e for e in elements if not e.is_a("IfcFeatureElement")]
-    elements = [e for e in elements if not e.is_a("IfcOpeningElement")]
-    elements = [e for e in elements if not e.is_a("IfcSpace")]
-    elements = [e for e in elements if not e.is_a("IfcFurnishingElement")]
-    elements = [e for e in elements if not e.is_a("IfcAnnotation")]
-    elements = [e for e in elements if not e.id() in obj_ids]
-    return elements
+    if not elements:
+        return []
+    schema = ifc_tools.get_schema(next(iter(elements)))
+    cfilter = ifc_tools.get_class_filter(schema, exclude, ("IfcProduct",))
+    return cfilter.filter(elements, obj_ids)
 
 
 def get_decomposed_elements(element, obj=None):
     """Returns a list of renderable elements form a base element"""
 
-    result = []
+    ifcfile = ifc_tools.get_element_file(element)
+    tree = ifc_tools.get_decomposition_tree(ifcfile)
+    result = {}  # used as an ordered set of ids
     if getattr(element, "Representation", None):
-        if element not in result:
-            result.append(element)
+        result[element.id()] = None
     if not obj or not hasattr(obj, "Group"):
-        child_ids = []
+        child_ids = set()
     else:
         # add child elements that are not yet rendered
-        child_ids = [c.StepId for c in obj.Group if hasattr(c, "StepId")]
-    for child in ifcopenshell.util.element.get_decomposition(
-        element, is_recursive=False
-    ):
-        if child.id() not in child_ids:
-            if child not in result:
-                result.append(child)
-            # for el in get_decomposed_elements(child, obj):
-            for el in ifcopenshell.util.element.get_decomposition(child):
-                if el not in result:
-                    result.append(el)
-    return result
+        child_ids = {c.StepId for c in obj.Group if hasattr(c, "StepId")}
+    for child in tree.get(element.id(), []):
+        if child in child_ids or child in result:
+            continue
+        result[child] = None
+        stack = list(reversed(tree.get(child, [])))
+        while stack:
+            eid = stack.pop()
+            if eid not in result:
+                result[eid] = None
+                stack.extend(reversed(tree.get(eid, [])))
+    return [ifcfile[eid] for eid in result]
+
+
+def get_shared_elements(ifcfile, elements):
+    """Sorts out elements whose geometry is identical to another element of the
+    list, because they only use the same mapped representation. Returns a list
+    of elements that need to be tessellated, and a {element id: [elements]}
+    dictionary of the elements that can reuse the geometry of each of them"""
+
+    contexts = ifc_tools.get_body_context_ids(ifcfile)
+    leaders = {}
+    unique = []
+    followers = {}
+    for element in elements:
+        key = get_mapping_key(element, contexts)
+        leader = leaders.get(key)
+        if key is None:
+            unique.append(element)
+        elif leader is None:
+            leaders[key] = element
+            unique.append(element)
+        else:
+            followers.setdefault(leader.id(), []).append(element)
+    return unique, followers
+
+
+def get_mapping_key(element, contexts):
+    """Returns a key identifying the geometry of an element which is only made
+    of one mapped item, or None"""
+
+    if getattr(element, "HasOpenings", None):
+        return None
+    if not getattr(element, "Representation", None):
+        return None
+    reps = element.Representation.Representations
+    if contexts:
+        reps = [r for r in reps if r.ContextOfItems.id() in contexts]
+    if len(reps) != 1 or len(reps[0].Items) != 1:
+        return None
+    item = reps[0].Items[0]
+    if not item.is_a("IfcMappedItem") or item.StyledByItem:
+        return None
+    target = item.MappingTarget.get_info(recursive=True, include_identifier=False)
+    # materials can also give their color to the geometry
+    material = ifcopenshell.util.element.get_material(element)
+    material = material.id() if material else None
+    return (item.MappingSource.id(), repr(target), material)
+
+
+def get_placement(element):
+    """Returns the FreeCAD placement of an element, without tessellating it"""
+
+    ifcfile = ifc_tools.get_element_file(element)
+    matrix = ifcopenshell.util.placement.get_local_placement(element.ObjectPlacement)
+    matrix[:3, 3] /= ifc_tools.get_scale(ifcfile)
+    return FreeCAD.Placement(FreeCAD.Matrix(*matrix.ravel().tolist()))
 
 
 def get_geom_iterator(ifcfile, elements, brep_mode):
@@ -356,74 +712,450 @@ def get_geom_iterator(ifcfile, elements, brep_mode):
     from the given ifcfile and elements list. brep_mode indicates
     if we want brep data or not"""
 
-    settings = ifcopenshell.geom.settings()
-    if brep_mode:
-        settings.set(settings.DISABLE_TRIANGULATION, True)
-        settings.set(settings.USE_BREP_DATA, True)
-        settings.set(settings.SEW_SHELLS, True)
-    body_contexts = ifc_tools.get_body_context_ids(ifcfile)  # TODO migrate here?
-    if body_contexts:
-        settings.set_context_ids(body_contexts)
-    cores = multiprocessing.cpu_count()
-    iterator = ifcopenshell.geom.iterator(settings, ifcfile, cores, include=elements)
-    if not iterator.initialize():
-        print("DEBUG: ifc_tools.get_geom_iterator: Invalid iterator")
-        return None
-    return iterator
+    return get_geom_service(ifcfile).get_iterator(ifcfile, elements, brep_mode)
 
 
-def get_cache(ifcfile):
-    """Returns the shape cache dictionary associated with this ifc file"""
+def get_geom_service(ifcfile):
+    """Returns the geometry service of the given ifcfile"""
 
-    for d in FreeCAD.listDocuments().values():
-        if hasattr(d, "Proxy") and hasattr(d.Proxy, "ifcfile"):
-            if d.Proxy.ifcfile == ifcfile:
-                if hasattr(d.Proxy, "ifccache") and d.Proxy.ifccache:
-                    return d.Proxy.ifccache
-        for o in d.Objects:
-            if hasattr(o, "Proxy") and hasattr(o.Proxy, "ifcfile"):
-                if o.Proxy.ifcfile == ifcfile:
-                    if hasattr(o.Proxy, "ifccache") and o.Proxy.ifccache:
-                        return o.Proxy.ifccache
-    # init a new cache
-    return {"Shape": {}, "Color": {}, "Coin": {}, "Placement": {}}
+    if ifcfile not in GEOM_SERVICES:
+        GEOM_SERVICES[ifcfile] = geom_service()
+    return GEOM_SERVICES[ifcfile]
 
 
-def set_cache(ifcfile, cache):
-    """Sets the given dictionary as shape cache for the given ifc file"""
+class geom_service:
+    """Creates geometry iterators for one IFC file, reusing their settings,
+    and reports the throughput of each run"""
 
-    for d in FreeCAD.listDocuments().values():
-        if hasattr(d, "Proxy") and hasattr(d.Proxy, "ifcfile"):
-            if d.Proxy.ifcfile == ifcfile:
-                d.Proxy.ifccache = cache
-                return
-        for o in d.Objects:
-            if hasattr(o, "Proxy") and hasattr(o.Proxy, "ifcfile"):
-                if o.Proxy.ifcfile == ifcfile:
-                    o.Proxy.ifccache = cache
-                    return
+    def __init__(self):
+        self.settings = {}  # (brep_mode, preferences, contexts): settings
+        self.lock = threading.Lock()
+        # the run of each thread
+        self.current = threading.local()
 
+    def get_settings(self, ifcfile, brep_mode):
+        """Returns the ifcopenshell geometry settings to use"""
 
-def set_representation(vobj, node):
-    """Sets the correct coin nodes for the given Part object"""
+        deflection = ifc_tools.PARAMS.GetFloat("Deflection", 1.0)
+        openings = ifc_tools.PARAMS.GetBool("SubtractOpenings", True)
+        contexts = tuple(ifc_tools.get_body_context_ids(ifcfile))
+        key = (brep_mode, deflection, openings, contexts)
+        with self.lock:
+            if key not in self.settings:
+                settings = ifcopenshell.geom.settings()
+                if brep_mode:
+                    settings.set(settings.DISABLE_TRIANGULATION, True)
+                    settings.set(settings.USE_BREP_DATA, True)
+                    settings.set(settings.SEW_SHELLS, True)
+                else:
+                    # the deflection preference is in mm
+                    settings.set_deflection_tolerance(deflection / ifc_tools.SCALE)
+                if not openings:
+                    settings.set(settings.DISABLE_OPENING_SUBTRACTIONS, True)
+                if contexts:
+                    settings.set_context_ids(list(contexts))
+                self.settings[key] = settings
+            return self.settings[key]
+
+    def get_iterator(self, ifcfile, elements, brep_mode):
+        """Returns an initialized iterator for the given elements, or None"""
+
+        settings = self.get_settings(ifcfile, brep_mode)
+        cores = get_cores()
+        self.begin(brep_mode)
+        iterator = ifcopenshell.geom.iterator(
+            settings, ifcfile, cores, include=elements
+        )
+        if not iterator.initialize():
+            print("DEBUG: ifc_tools.get_geom_iterator: Invalid iterator")
+            return None
+        return iterator
+
+    def begin(self, brep_mode):
+        """Marks the start of a run"""
+
+        self.current.start = time.time()
+        self.current.brep_mode = brep_mode
+
+    def report(self, count):
+        """Prints the throughput of the last run, for the given number of elements"""
+
+        if getattr(self.current, "start", None) is None:
+            return
+        duration = max(time.time() - self.current.start, 1e-6)
+        FreeCAD.Console.PrintLog(
+            "IFC: Generated {} {} in {:.2f}s ({:.0f} elements/s)\n".format(
+                count,
+                "shapes" if self.current.brep_mode else "meshes",
+                duration,
+                count / duration,
+            )
+        )
+        self.current.start = None
+
+
+def get_cores():
+    """Returns the number of threads to use to generate geometry"""
+
+    cores = ifc_tools.PARAMS.GetInt("GeometryCores", 0)
+    if cores <= 0:
+        # use all cores
+        cores = multiprocessing.cpu_count()
+    return cores
+
+
+def get_representation_nodes(vobj):
+    """Returns the SoCoordinate3, SoBrepFaceSet and SoBrepEdgeSet nodes of the
+    given Part object"""
 
-    # node = [colors, verts, faces, edges, parts]
     coords = vobj.RootNode.getChild(1)  # SoCoordinate3
     fset = vobj.RootNode.getChild(2).getChild(1).getChild(6)  # SoBrepFaceSet
     eset = (
         vobj.RootNode.getChild(2).getChild(2).getChild(0).getChild(3)
     )  # SoBrepEdgeSet
+    return coords, fset, eset
+
+
+def set_representation(vobj, node):
+    """Sets the correct coin nodes for the given Part object"""
+
+    # node = [colors, verts, faces, edges, parts]
+    coords, fset, eset = get_representation_nodes(vobj)
     # reset faces and edges
+    fset.partIndex.deleteValues(0)
     fset.coordIndex.deleteValues(0)
     eset.coordIndex.deleteValues(0)
     coords.point.deleteValues(0)
     if not node:
         return
-    if node[1] and node[2] and node[3] and node[4]:
-        coords.point.setValues(node[1])
-        fset.coordIndex.setValues(node[2])
-        fset.partIndex.setValues(node[4])
-        eset.coordIndex.setValues(node[3])
+    if len(node[1]) and len(node[2]) and len(node[3]) and len(node[4]):
+        set_field(coords.point, node[1])
+        set_field(fset.coordIndex, node[2])
+        set_field(fset.partIndex, node[4])
+        set_field(eset.coordIndex, node[3])
+
+
+def set_field(field, values, start=0):
+    """Sets the values of a coin multiple-value field from an array, from the
+    given index on. When pivy supports it, the array buffer is passed as is,
+    otherwise every value needs to be converted to a Python object first"""
+
+    global NUMPY_FIELDS
+
+    if isinstance(field, coin.SoMFVec3f):
+        values = numpy.ascontiguousarray(values, dtype=numpy.float32)
+    else:
+        values = numpy.ascontiguousarray(values, dtype=numpy.int32)
+    if NUMPY_FIELDS is not False:
+        try:
+            field.setValues(start, len(values), values)
+            NUMPY_FIELDS = True
+            return
+        except (TypeError, ValueError, NotImplementedError):
+            # this pivy version doesn't accept arrays
+            NUMPY_FIELDS = False
+    field.setValues(start, len(values), values.tolist())
+
+
+class coin_stream:
+    """Appends batches of coin nodes to the representation of a view provider,
+    at most once per interval, so a partial model can be seen and navigated
+    while the rest is being generated. The final node must still be set with
+    set_representation"""
+
+    background = False  # if this stream is fed from another thread
+    cancelled = False  # if the generation must stop
+    cache = None  # the geometry cache to use from another thread
+    disk = None  # the disk cache to use from another thread
+
+    def __init__(self, vobj, interval=0.2):
+        self.vobj = vobj
+        self.interval = interval
+        self.last = time.time()
+        self.done = 0  # number of nodes already pushed
+        self.offset = 0  # number of verts already pushed
+
+    def push(self, nodes, placements=None):
+        """Adds the nodes not pushed yet to the view provider"""
+
+        if time.time() - self.last < self.interval:
+            return
+        if placements:
+            placements = placements[self.done :]
+        node = unify(nodes[self.done :], placements)
+        self.send(node, self.offset, not self.done)
+        self.done = len(nodes)
+        self.offset += len(node[1])
+        self.last = time.time()
+
+    def send(self, node, offset, first):
+        """Adds a node to the view provider"""
+
+        if first:
+            set_representation(self.vobj, None)
+        append_representation(self.vobj, node, offset)
+        FreeCADGui.updateGui()
+
+
+class coin_job(coin_stream):
+    """Generates the coin representation of an object in a background thread.
+    Batches of nodes are passed to the GUI thread, which adds them to the
+    scene. The bounding boxes of the elements are shown until the first batch
+    arrives. The job can be cancelled from the status bar, in which case the
+    elements generated so far are kept"""
+
+    background = True
+
+    def __init__(self, obj, ifcfile, elements, cached=False):
+        super().__init__(obj.ViewObject)
+        self.docname = obj.Document.Name
+        self.objname = obj.Name
+        self.label = obj.Label
+        self.ifcfile = ifcfile
+        self.elements = elements
+        self.cached = cached
+        self.batches = queue.Queue()
+        self.count = 0
+        self.result = None
+        self.finished = False
+        self.superseded = False
+        self.cache = ifc_cache.get_cache(ifcfile)
+        self.disk = ifc_cache.get_disk_cache(ifcfile, "Coin")
+
+    def start(self):
+        """Shows the placeholder and starts the generation"""
+
+        from PySide import QtCore, QtGui  # lazy import
+
+        placeholder = get_placeholder(self.elements)
+        if placeholder:
+            set_representation(self.vobj, placeholder)
+        self.button = QtGui.QPushButton()
+        self.button.clicked.connect(self.cancel)
+        self.update_button()
+        FreeCADGui.getMainWindow().statusBar().addPermanentWidget(self.button)
+        # jobs of the same file run one after the other
+        if self.ifcfile not in WORKERS:
+            WORKERS[self.ifcfile] = job_worker()
+        WORKERS[self.ifcfile].put(self)
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(100)
+
+    def run(self):
+        """Generates the node. Runs in the background thread"""
+
+        if self.cancelled:
+            # cancelled before it could start
+            self.finished = True
+            return
+        try:
+            self.result = generate_coin(self.ifcfile, self.elements, self.cached, self)
+        except Exception as e:
+            message = "IFC: Geometry generation failed: {}\n".format(e)
+            FreeCAD.Console.PrintError(message)
+        self.finished = True
+
+    def push(self, nodes, placements=None):
+        """Passes the nodes not pushed yet to the GUI thread"""
+
+        self.count = len(nodes)
+        super().push(nodes, placements)
+
+    def send(self, node, offset, first):
+        """Queues a node for the GUI thread"""
+
+        self.batches.put((node, offset, first))
+
+    def poll(self):
+        """Adds the queued nodes to the scene. Runs in the GUI thread"""
+
+        obj = self.get_object()
+        while not self.batches.empty():
+            node, offset, first = self.batches.get()
+            if obj and not self.superseded:
+                super().send(node, offset, first)
+        self.update_button()
+        if not self.finished:
+            return
+        self.timer.stop()
+        self.button.hide()
+        FreeCADGui.getMainWindow().statusBar().removeWidget(self.button)
+        self.button.deleteLater()
+        if JOBS.get((self.docname, self.objname)) is self:
+            del JOBS[(self.docname, self.objname)]
+        if not obj or self.superseded:
+            return
+        node, placement = self.result or (None, None)
+        # partial nodes can't be patched later
+        keep_node(obj, self.ifcfile, None if self.cancelled else node)
+        set_representation(obj.ViewObject, node)
+        if node:
+            ifc_tools.set_colors(obj, node[0])
+        else:
+            print_debug(obj)
+        if placement:
+            obj.Placement = placement
+
+    def cancel(self, superseded=False):
+        """Stops the generation. If superseded is True, the generated nodes
+        are discarded, as another job is taking over"""
+
+        self.cancelled = True
+        self.superseded = superseded
+
+    def update_button(self):
+        """Updates the text of the cancel button"""
+
+        text = "Cancel loading {} ({}/{})"
+        self.button.setText(text.format(self.label, self.count, len(self.elements)))
+
+    def get_object(self):
+        """Returns the document object of this job, if it still exists"""
+
+        if self.docname not in FreeCAD.listDocuments():
+            return None
+        return FreeCAD.getDocument(self.docname).getObject(self.objname)
+
+
+class job_worker:
+    """Runs coin jobs one after the other in a background thread, which ends
+    when there are no more jobs to run"""
+
+    def __init__(self):
+        self.jobs = collections.deque()
+        self.lock = threading.Lock()
+        self.thread = None  # the running thread, if any
+        self.current = None  # the running job, if any
+
+    def put(self, job):
+        """Adds a job to run"""
+
+        with self.lock:
+            self.jobs.append(job)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """Cancels the queued and running jobs and waits for the thread to end.
+        Returns the jobs that have been cancelled"""
+
+        with self.lock:
+            jobs = list(self.jobs)
+            if self.current:
+                jobs.append(self.current)
+            thread = self.thread
+        jobs = [job for job in jobs if not job.cancelled]
+        for job in jobs:
+            job.cancel()
+        if thread:
+            thread.join()
+        return jobs
+
+    def run(self):
+        """Runs the queued jobs. Runs in the background thread"""
+
+        disk = None
+        while True:
+            with self.lock:
+                if not self.jobs:
+                    self.current = None
+                    self.thread = None
+                    break
+                job = self.current = self.jobs.popleft()
+            job.run()
+            disk = job.disk
+        # write what the jobs have added to the disk cache, once
+        if disk:
+            disk.save()
+
+
+def stop_jobs(ifcfile):
+    """Cancels the background coin jobs of an ifc file and waits until they
+    have stopped, so the file can be modified. Returns the objects whose
+    geometry was being generated, which need to be generated again"""
+
+    worker = WORKERS.get(ifcfile)
+    if not worker:
+        return []
+    objs = [job.get_object() for job in worker.stop()]
+    return [obj for obj in objs if obj]
+
+
+class null_progress:
+    """A progress indicator that does nothing, for use outside the GUI thread"""
+
+    def start(self, text, total):
+        pass
+
+    def next(self, value=True):
+        pass
+
+    def stop(self):
+        pass
+
+
+def get_progressbar(stream=None):
+    """Returns a progress indicator suited to the given coin stream"""
+
+    if stream and stream.background:
+        return null_progress()
+    return Base.ProgressIndicator()
+
+
+def get_placeholder(elements):
+    """Returns a coin node made of the bounding boxes of the given elements,
+    taken from their Box representation, if any"""
+
+    nodes = []
+    placements = []
+    for element in elements:
+        representation = getattr(element, "Representation", None)
+        if not representation:
+            continue
+        for rep in representation.Representations:
+            if rep.RepresentationIdentifier == "Box":
+                for item in rep.Items:
+                    if item.is_a("IfcBoundingBox"):
+                        nodes.append(get_box_node(item))
+                        placements.append(get_placement(element))
+    if not nodes:
+        return None
+    return unify(nodes, placements)
+
+
+def get_box_node(box):
+    """Returns a coin node from an IfcBoundingBox"""
+
+    scale = 1.0 / ifc_tools.get_scale(ifc_tools.get_element_file(box))
+    corner = numpy.array(box.Corner.Coordinates, dtype=numpy.float64)
+    size = numpy.array([box.XDim, box.YDim, box.ZDim], dtype=numpy.float64)
+    bits = numpy.array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)])
+    verts = ((corner + bits * size) * scale).astype(numpy.float32)
+    # split each quad into two triangles
+    faces = [i for f in BOX_FACES for i in (f[0], f[1], f[2], f[0], f[2], f[3])]
+    faces = delimit(faces, 3)
+    edges = delimit(BOX_EDGES, 2)
+    return [(0.85, 0.85, 0.85), verts, faces, edges]
+
+
+def append_representation(vobj, node, offset):
+    """Appends a node to the coin nodes of the given Part object. The verts
+    of the node are numbered after the given number of existing verts"""
+
+    coords, fset, eset = get_representation_nodes(vobj)
+    if not len(node[1]):
+        return
+    faces = numpy.where(node[2] >= 0, node[2] + offset, node[2])
+    edges = numpy.where(node[3] >= 0, node[3] + offset, node[3])
+    for field, values in (
+        (coords.point, node[1]),
+        (fset.coordIndex, faces),
+        (fset.partIndex, node[4]),
+        (eset.coordIndex, edges),
+    ):
+        set_field(field, values, field.getNum())
 
 
 def print_debug(obj):
@@ -443,29 +1175,118 @@ def print_debug(obj):
     )
 
 
+def delimit(indices, size):
+    """Returns a flat array of the given indices, with a -1 inserted after
+    each group of size indices, as expected by coin index fields"""
+
+    indices = numpy.array(indices, dtype=numpy.int32).reshape(-1, size)
+    result = numpy.full((len(indices), size + 1), -1, dtype=numpy.int32)
+    result[:, :size] = indices
+    return result.ravel()
+
+
 def apply_placement(node, placement):
     """Applies the given placement to the verts in the given node"""
 
-    verts = [tuple(placement.multVec(FreeCAD.Vector(v))) for v in node[1]]
+    verts = apply_placements(node[1], [placement], [len(node[1])])
     return [node[0], verts, node[2], node[3]]
 
 
-def unify(nodes):
-    """group the subcomponents of a node into one single set of verts, faces, edges"""
+def apply_placements(verts, placements, counts, chunk=1 << 20):
+    """Transforms the given verts array, applying each placement to the
+    corresponding number of consecutive verts given in counts"""
+
+    # coin works in single precision anyway
+    matrices = numpy.array([p.toMatrix().A for p in placements], numpy.float32)
+    matrices = matrices.reshape(-1, 4, 4)[:, :3, :]
+    index = numpy.repeat(numpy.arange(len(counts)), counts)
+    result = numpy.empty(verts.shape, dtype=numpy.float32)
+    # process in chunks, to limit the memory taken by per-vertex matrices
+    for start in range(0, len(verts), chunk):
+        mats = matrices[index[start : start + chunk]]
+        vecs = verts[start : start + chunk]
+        trans = numpy.einsum("kij,kj->ki", mats[:, :, :3], vecs) + mats[:, :, 3]
+        result[start : start + chunk] = trans
+    return result
 
-    colors = []
-    verts = []
-    faces = []
-    edges = []
-    parts = []
-    for node in nodes:
-        vindex = len(verts)
-        colors.append(node[0])
-        verts.extend(node[1])
-        faces.extend([i + vindex if i >= 0 else i for i in node[2]])
-        edges.extend([i + vindex if i >= 0 else i for i in node[3]])
-        parts.append(len(node[2]) // 4)
-    return [colors, verts, faces, edges, parts]
+
+def unify(nodes, placements=None, ids=None):
+    """group the subcomponents of a node into one single set of verts, faces, edges.
+    If placements are given, they are applied to the verts of each node. If the
+    element ids of the nodes are given, a table of the number of verts, face and
+    edge indices of each part is added to the result, to allow to patch it"""
+
+    colors = [node[0] for node in nodes]
+    parts = [len(node[2]) // 4 for node in nodes]
+    if not nodes:
+        empty = numpy.empty(0, dtype=numpy.int32)
+        return [colors, numpy.empty((0, 3), numpy.float32), empty, empty, parts]
+    if ids is not None:
+        table = {
+            "ids": list(ids),
+            "verts": [len(node[1]) for node in nodes],
+            "faces": [len(node[2]) for node in nodes],
+            "edges": [len(node[3]) for node in nodes],
+        }
+    counts = numpy.array([len(node[1]) for node in nodes])
+    verts = numpy.concatenate([node[1] for node in nodes])
+    if placements:
+        verts = apply_placements(verts, placements, counts)
+    # shift the indices of each node by the number of verts that precede it
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1])).astype(numpy.int32)
+    indices = []
+    for i in (2, 3):
+        lengths = [len(node[i]) for node in nodes]
+        index = numpy.concatenate([node[i] for node in nodes])
+        shift = numpy.repeat(offsets, lengths)
+        indices.append(numpy.where(index >= 0, index + shift, index))
+    if ids is not None:
+        return [colors, verts, indices[0], indices[1], parts, table]
+    return [colors, verts, indices[0], indices[1], parts]
+
+
+def splice(node, index, part):
+    """Replaces the part at the given index of a unified node with the verts,
+    faces and edges of the given node. Returns True if the size of the arrays
+    of the unified node has changed"""
+
+    table = node[5]
+    vstart, fstart, estart = get_part_offsets(table, index)
+    vcount = table["verts"][index]
+    delta = len(part[1]) - vcount
+    node[1] = numpy.concatenate(
+        (node[1][:vstart], part[1], node[1][vstart + vcount :])
+    ).astype(numpy.float32)
+    for i, key, start in ((2, "faces", fstart), (3, "edges", estart)):
+        count = table[key][index]
+        new = numpy.where(part[i] >= 0, part[i] + vstart, part[i])
+        rest = node[i][start + count :]
+        if delta:
+            # the verts after this part have moved
+            rest = numpy.where(rest >= 0, rest + delta, rest)
+        node[i] = numpy.concatenate((node[i][:start], new, rest)).astype(numpy.int32)
+    resized = (
+        delta != 0
+        or len(part[2]) != table["faces"][index]
+        or len(part[3]) != table["edges"][index]
+    )
+    node[0][index] = part[0]
+    node[4][index] = len(part[2]) // 4
+    table["verts"][index] = len(part[1])
+    table["faces"][index] = len(part[2])
+    table["edges"][index] = len(part[3])
+    return resized
+
+
+def get_part_offsets(table, index):
+    """Returns the index of the first vert, face index and edge index of the
+    part at the given index of a unified node"""
+
+    return (
+        sum(table["verts"][:index]),
+        sum(table["faces"][:index]),
+        sum(table["edges"][:index]),
+    )
 
 
 def create_ghost(document, ifcfile, project):
@@ -155,6 +155,7 @@ def set_attribute(ifcfile, element, prop, value):
     return False
 
 
+@ifc_tools.api_batch("Geometry edit")
 def set_geom_property(obj, prop):
     """Updates the internal IFC file with the given value"""
 
@@ -215,7 +216,7 @@ def set_geom_property(obj, prop):
                         if rep.Items[0].SweptArea.is_a("IfcArbitraryClosedProfileDef"):
                             if rep.Items[0].SweptArea.OuterCurve.is_a("IfcPolyline"):
                                 elem = rep.Items[0].SweptArea.OuterCurve
-                                elem_points = elem.Points
+                                elem_points = list(elem.Points)
                                 psize = elem_points[0].Dim
                                 points = getattr(obj, prop)
                                 if len(points) > len(elem_points):
@@ -226,12 +227,22 @@ def set_geom_property(obj, prop):
                                             ifc_class="IfcCartesianPoint",
                                         )
                                         elem_points.append(p)
-                                    elem.Points = elem_points
+                                    ifc_tools.api_run(
+                                        "attribute.edit_attributes",
+                                        ifcfile,
+                                        product=elem,
+                                        attributes={"Points": elem_points},
+                                    )
                                 elif len(points) < len(elem_points):
                                     rest = []
                                     for i in range(len(elem_points) - len(points)):
                                         rest.append(elem_points.pop())
-                                    elem.Points = elem_points
+                                    ifc_tools.api_run(
+                                        "attribute.edit_attributes",
+                                        ifcfile,
+                                        product=elem,
+                                        attributes={"Points": elem_points},
+                                    )
                                     for r in rest:
                                         ifc_tools.api_run(
                                             "root.remove_product", ifcfile, product=r
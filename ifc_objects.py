@@ -107,9 +107,15 @@ class ifc_object:
 
         import ifc_tools  # lazy import
 
-        obj.Class = [obj.IfcClass]
-        obj.Class = ifc_tools.get_ifc_classes(obj, obj.IfcClass)
-        obj.Class = obj.IfcClass
+        if (
+            getattr(self, "classlist", None) != obj.IfcClass
+            or obj.Class != obj.IfcClass
+        ):
+            obj.Class = [obj.IfcClass]
+            obj.Class = ifc_tools.get_ifc_classes(obj, obj.IfcClass)
+            obj.Class = obj.IfcClass
+            # the class list only needs to be rebuilt when the class changes
+            self.classlist = obj.IfcClass
         if setprops:
             ifc_tools.remove_unused_properties(obj)
             ifc_tools.add_properties(obj)
@@ -143,6 +149,12 @@ class ifc_object:
             g.append(child)
             obj.Group = g
 
+    def addObjects(self, obj, children):
+        g = obj.Group
+        names = set([o.Name for o in g])
+        g.extend([c for c in children if c.Name not in names])
+        obj.Group = g
+
     def removeObject(self, obj, child):
         if child in obj.Group:
             g = obj.Group
@@ -162,7 +174,9 @@ class ifc_object:
             result = ifc_tools.set_attribute(ifcfile, elt, attribute, value)
             if result:
                 if hasattr(result, "id") and (result.id() != obj.StepId):
+                    ifc_tools.unregister_object(obj)
                     obj.StepId = result.id()
+                    ifc_tools.register_object(obj, ifcfile)
 
     def edit_geometry(self, obj, prop):
         """Edits a geometry property of an object"""
@@ -191,14 +205,8 @@ class ifc_object:
                     return
             ifcfile, migration_table = ifc_tools.migrate_schema(ifcfile, schema)
             self.ifcfile = ifcfile
-            for old_id, new_id in migration_table.items():
-                child = [
-                    o
-                    for o in obj.OutListRecursive
-                    if getattr(o, "StepId", None) == old_id
-                ]
-                if len(child) == 1:
-                    child[0].StepId = new_id
+            ifc_tools.register_project(obj, ifcfile)
+            ifc_tools.migrate_objects(obj.OutListRecursive, migration_table, ifcfile)
 
     def edit_placement(self, obj):
         """Syncs the internal IFC placement"""
@@ -228,21 +236,22 @@ class ifc_object:
             if not ifcfile:
                 return
             newlist = []
-            for child in obj.Group:
-                if (
-                    not getattr(child, "StepId", None)
-                    or ifc_tools.get_ifcfile(child) != ifcfile
-                ):
-                    print(
-                        "DEBUG: Not an IFC object. Removing",
-                        child.Label,
-                        "from layer",
-                        obj.Label,
-                    )
-                else:
-                    # print("DEBUG: adding", child.Label, "to layer", obj.Label)
-                    newlist.append(child)
-                    ifc_layers.add_to_layer(child, obj)
+            with ifc_tools.api_batch("Layer assignment"):
+                for child in obj.Group:
+                    if (
+                        not getattr(child, "StepId", None)
+                        or ifc_tools.get_ifcfile(child) != ifcfile
+                    ):
+                        print(
+                            "DEBUG: Not an IFC object. Removing",
+                            child.Label,
+                            "from layer",
+                            obj.Label,
+                        )
+                    else:
+                        # print("DEBUG: adding", child.Label, "to layer", obj.Label)
+                        newlist.append(child)
+                        ifc_layers.add_to_layer(child, obj)
             if newlist != obj.Group:
                 obj.Group = newlist
 
@@ -61,6 +61,10 @@ class ifc_observer:
 
         import ifc_tools  # lazy loading
 
+        if hasattr(obj, "StepId"):
+            ifc_tools.unregister_object(obj)
+        if hasattr(obj, "IfcFilePath"):
+            ifc_tools.unregister_project(obj)
         proj = ifc_tools.get_project(obj)
         if not proj:
             return
@@ -84,19 +88,47 @@ class ifc_observer:
                     # TODO display warming
                     ifcfile, migration_table = ifc_tools.migrate_schema(ifcfile, schema)
                     doc.Proxy.ifcfile = ifcfile
+                    ifc_tools.register_project(doc, ifcfile)
                     # migrate children
-                    for old_id, new_id in migration_table.items():
-                        child = [
-                            o
-                            for o in doc.Objects
-                            if getattr(o, "StepId", None) == old_id
-                        ]
-                        if len(child) == 1:
-                            child[0].StepId = new_id
+                    ifc_tools.migrate_objects(doc.Objects, migration_table, ifcfile)
                 ifc_status.toggle_lock(True)
             else:
                 ifc_status.toggle_lock(False)
 
+    def slotFinishRestoreDocument(self, doc):
+        """Rebuild the object lookup tables of restored documents"""
+
+        self.clear_registry(doc)
+
+    def slotUndoDocument(self, doc):
+        """Rebuild the object lookup tables after undoing"""
+
+        self.clear_registry(doc)
+
+    def slotRedoDocument(self, doc):
+        """Rebuild the object lookup tables after redoing"""
+
+        self.clear_registry(doc)
+
+    def slotRecomputedDocument(self, doc):
+        """Write the geometry generated during the recompute to the disk cache"""
+
+        self.save_disk_caches()
+
+    def slotDeletedDocument(self, doc):
+        """Discard the object and project lookup tables of closed documents"""
+
+        import sys
+
+        self.clear_registry(doc)
+        self.save_disk_caches()
+        if "ifc_tools" in sys.modules:
+            ifc_tools = sys.modules["ifc_tools"]
+            ifc_tools.unregister_project(doc)
+            for obj in doc.Objects:
+                if hasattr(obj, "IfcFilePath"):
+                    ifc_tools.unregister_project(obj)
+
     def slotCreatedObject(self, obj):
         """If this is an IFC document, turn the object into IFC"""
 
@@ -134,6 +166,24 @@ class ifc_observer:
 
             FreeCADGui.SendMsgToActiveView("ViewFit")
 
+    def clear_registry(self, doc):
+        """Discards the object lookup tables of IFC documents contained in doc"""
+
+        import sys
+
+        # do not load ifc_tools if no IFC file has been opened yet
+        if "ifc_tools" in sys.modules:
+            sys.modules["ifc_tools"].clear_registry(doc)
+
+    def save_disk_caches(self):
+        """Writes the changed geometry disk caches of all IFC files"""
+
+        import sys
+
+        # do not load ifc_cache if no geometry has been generated yet
+        if "ifc_cache" in sys.modules:
+            sys.modules["ifc_cache"].save_disk_caches()
+
     def save(self):
         """Saves all IFC documents contained in self.docname Document"""
 
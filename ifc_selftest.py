@@ -38,7 +38,10 @@ import ifc_layers
 import ifc_psets
 import ifc_objects
 import ifc_generator
+import ifc_cache
 import ifcopenshell
+import ifcopenshell.util.element
+import numpy
 import difflib
 
 IFCOPENHOUSE_IFC4 = (
@@ -385,3 +388,206 @@ class NativeIFCTest(unittest.TestCase):
         pset = ifc_psets.add_pset(obj, "Pset_Custom")
         ifc_psets.add_property(ifcfile, pset, "MyMessageToTheWorld", "Hello, World!")
         self.failUnless(ifc_psets.has_psets(obj), "Psets failed")
+
+    def test16_ObjectRegistry(self):
+        FreeCAD.Console.PrintMessage("16. NativeIFC Object registry...")
+        clearObjects()
+        fp = getIfcFilePath()
+        ifc_import.insert(
+            fp,
+            "IfcTest",
+            strategy=2,
+            shapemode=1,
+            switchwb=0,
+            silent=True,
+            singledoc=SINGLEDOC,
+        )
+        obj = FreeCAD.getDocument("IfcTest").getObject("IfcObject004")
+        ifcfile = ifc_tools.get_ifcfile(obj)
+        stepid = obj.StepId
+        found = ifc_tools.get_object(ifcfile[stepid])
+        FreeCAD.getDocument("IfcTest").removeObject("IfcObject004")
+        registry = ifc_tools.get_registry(ifcfile)
+        self.failUnless(
+            found == obj and stepid not in registry["StepId"], "ObjectRegistry failed"
+        )
+
+    def test17_GeometryUsers(self):
+        FreeCAD.Console.PrintMessage("17. NativeIFC Geometry users...")
+        clearObjects()
+        fp = getIfcFilePath()
+        ifc_import.insert(
+            fp,
+            "IfcTest",
+            strategy=2,
+            shapemode=0,
+            switchwb=0,
+            silent=True,
+            singledoc=SINGLEDOC,
+        )
+        obj = FreeCAD.getDocument("IfcTest").getObject("IfcObject004")
+        ifcfile = ifc_tools.get_ifcfile(obj)
+        element = ifc_tools.get_ifc_element(obj)
+        item = element.Representation.Representations[0].Items[0]
+        users = ifc_tools.get_geometry_users(ifcfile, item)
+        self.failUnless(element.id() in users, "GeometryUsers failed")
+
+    def test18_StoreyShape(self):
+        FreeCAD.Console.PrintMessage("18. NativeIFC Storey in shape mode...")
+        clearObjects()
+        fp = getIfcFilePath()
+        ifc_import.insert(
+            fp,
+            "IfcTest",
+            strategy=2,
+            shapemode=1,
+            switchwb=0,
+            silent=True,
+            singledoc=SINGLEDOC,
+        )
+        ifcfile = ifc_tools.get_ifcfile(FreeCAD.getDocument("IfcTest").Objects[-1])
+        storey = ifcfile.by_type("IfcBuildingStorey")[0]
+        elements = ifc_generator.get_decomposed_elements(storey)
+        elements = ifc_generator.filter_types(elements)
+        shape, colors = ifc_generator.generate_shape(ifcfile, elements)
+        self.failUnless(shape and not shape.isNull(), "StoreyShape failed")
+
+    def test19_CacheBudget(self):
+        FreeCAD.Console.PrintMessage("19. NativeIFC Geometry cache budget...")
+        cache = ifc_cache.geometry_cache(budget=1000)
+        empty = numpy.empty(0, numpy.int32)
+
+        def node():
+            # 360 bytes of verts
+            return [(0.8, 0.8, 0.8), numpy.zeros((30, 3), numpy.float32), empty, empty]
+
+        shared = node()
+        cache.set("Coin", 1, shared)
+        cache.set("Coin", 2, shared)
+        size = cache.size
+        cache.set("Coin", 3, node())
+        cache.set("Coin", 4, node())
+        # both users of the shared node must go to free its memory
+        self.failUnless(
+            size == 360
+            and cache.size == 720
+            and cache.evictions == 2
+            and cache.get("Coin", 1) is None
+            and cache.get("Coin", 4) is not None,
+            "CacheBudget failed",
+        )
+
+    def test20_SpliceNode(self):
+        FreeCAD.Console.PrintMessage("20. NativeIFC Splice coin node...")
+
+        def part(count, color):
+            verts = numpy.arange(count * 3, dtype=numpy.float32).reshape(-1, 3)
+            faces = numpy.array([0, 1, 2, -1] * (count - 2), numpy.int32)
+            edges = numpy.array([0, count - 1, -1], numpy.int32)
+            return [color, verts, faces, edges]
+
+        a = part(3, (1.0, 0.0, 0.0))
+        b = part(4, (0.0, 1.0, 0.0))
+        c = part(3, (0.0, 0.0, 1.0))
+        node = ifc_generator.unify([a, b, c], ids=[1, 2, 3])
+        new = part(6, (1.0, 1.0, 0.0))
+        resized = ifc_generator.splice(node, 1, new)
+        target = ifc_generator.unify([a, new, c], ids=[1, 2, 3])
+        same = all([(node[i] == target[i]).all() for i in (1, 2, 3)])
+        self.failUnless(
+            resized and same and node[0] == target[0] and node[4:] == target[4:],
+            "SpliceNode failed",
+        )
+
+    def test21_OwnedTree(self):
+        FreeCAD.Console.PrintMessage("21. NativeIFC Owned tree...")
+        clearObjects()
+        fp = getIfcFilePath()
+        ifc_import.insert(
+            fp,
+            "IfcTest",
+            strategy=2,
+            shapemode=1,
+            switchwb=0,
+            silent=True,
+            singledoc=SINGLEDOC,
+        )
+        doc = FreeCAD.getDocument("IfcTest")
+
+        def owned(objs):
+            # what remove_tree used to remove
+            names = set([o.Name for o in objs])
+            for obj in objs:
+                names |= set([o.Name for o in obj.OutListRecursive])
+            return set(
+                [
+                    n
+                    for n in names
+                    if all([p.Name in names for p in doc.getObject(n).InList])
+                ]
+            )
+
+        same = True
+        for objs in [[o] for o in doc.Objects] + [doc.Objects]:
+            tree = ifc_tools.get_owned_tree(objs)
+            if set([o.Name for o in tree]) != owned(objs):
+                same = False
+        self.failUnless(same, "OwnedTree failed")
+
+    def test22_DecomposedElements(self):
+        FreeCAD.Console.PrintMessage("22. NativeIFC Decomposed elements...")
+        clearObjects()
+        fp = getIfcFilePath()
+        ifc_import.insert(
+            fp,
+            "IfcTest",
+            strategy=0,
+            shapemode=1,
+            switchwb=0,
+            silent=True,
+            singledoc=SINGLEDOC,
+        )
+        ifcfile = ifc_tools.get_ifcfile(FreeCAD.getDocument("IfcTest").Objects[-1])
+        same = True
+        for element in ifcfile.by_type("IfcObjectDefinition"):
+            # what ifcopenshell finds
+            ids = set()
+            if getattr(element, "Representation", None):
+                ids.add(element.id())
+            get_decomposition = ifcopenshell.util.element.get_decomposition
+            for child in get_decomposition(element, is_recursive=False):
+                ids.add(child.id())
+                ids |= set([e.id() for e in get_decomposition(child)])
+            elements = ifc_generator.get_decomposed_elements(element)
+            result = [e.id() for e in elements]
+            if set(result) != ids or len(result) != len(ids):
+                same = False
+        self.failUnless(same, "DecomposedElements failed")
+
+    def test23_OrphanElements(self):
+        FreeCAD.Console.PrintMessage("23. NativeIFC Orphan elements...")
+        clearObjects()
+        fp = getIfcFilePath()
+        ifc_import.insert(
+            fp,
+            "IfcTest",
+            strategy=0,
+            shapemode=1,
+            switchwb=0,
+            silent=True,
+            singledoc=SINGLEDOC,
+        )
+        ifcfile = ifc_tools.get_ifcfile(FreeCAD.getDocument("IfcTest").Objects[-1])
+        wall = ifc_tools.api_run("root.create_entity", ifcfile, ifc_class="IfcWall")
+        # what the inverse attributes tell
+        ids = set(
+            [
+                e.id()
+                for e in ifcfile.by_type("IfcElement")
+                if not e.Decomposes
+                and not e.ContainedInStructure
+                and not getattr(e, "VoidsElements", None)
+            ]
+        )
+        result = set([e.id() for e in ifc_tools.get_orphan_elements(ifcfile)])
+        self.failUnless(result == ids and wall.id() in ids, "OrphanElements failed")
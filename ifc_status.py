@@ -168,9 +168,10 @@ def lock_document():
             children = project.OutListRecursive
             rest = [o for o in doc.Objects if o not in children and o != project]
             doc.openTransaction("Lock document")
-            ifc_tools.convert_document(
-                doc, filename=project.IfcFilePath, strategy=3, silent=True
-            )
+            with ifc_tools.api_batch("Lock document"):
+                ifc_tools.convert_document(
+                    doc, filename=project.IfcFilePath, strategy=3, silent=True
+                )
             ifcfile = doc.Proxy.ifcfile
             if rest:
                 # 1b some objects are outside
@@ -209,7 +210,8 @@ def lock_document():
         elif doc.Objects:
             # 3 there is no project but objects
             doc.openTransaction("Lock document")
-            ifc_tools.convert_document(doc, silent=True)
+            with ifc_tools.api_batch("Lock document"):
+                ifc_tools.convert_document(doc, silent=True)
             ifcfile = doc.Proxy.ifcfile
             objs = find_toplevel(doc.Objects)
             prefs, context = ifc_tools.get_export_preferences(ifcfile)
@@ -222,7 +224,8 @@ def lock_document():
             doc.recompute()
         else:
             # 4 this is an empty document
-            ifc_tools.convert_document(doc, silent=True)
+            with ifc_tools.api_batch("Lock document"):
+                ifc_tools.convert_document(doc, silent=True)
 
 
 def find_toplevel(objs):
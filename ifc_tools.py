@@ -23,6 +23,9 @@
 """This is the main NativeIFC module"""
 
 import os
+import time
+import weakref
+import functools
 
 # heavyweight libraries - ifc_tools should always be lazy loaded
 
@@ -51,6 +54,51 @@ SHORT = False  # If True, only Step ID attribute is created
 ROUND = 8  # rounding value for placements
 DEFAULT_SHAPEMODE = "Coin"  # Can be Shape, Coin or None
 PARAMS = FreeCAD.ParamGet("User parameter:BaseApp/Preferences/Mod/NativeIFC")
+REGISTRY = weakref.WeakKeyDictionary()  # ifcfile: {"StepId": {}, "GlobalId": {}}
+PROJECTS = weakref.WeakKeyDictionary()  # ifcfile: project object or document
+BATCHES = []  # the api_batch contexts currently running
+SCALES = weakref.WeakKeyDictionary()  # ifcfile: scale factor to mm
+ORPHANS = weakref.WeakKeyDictionary()  # ifcfile: list of orphan element ids
+CONTEXTS = weakref.WeakKeyDictionary()  # ifcfile: list of body context ids
+# ifcfile: ({entity id: product ids}, {(product id, attribute): entity ids})
+USERS = weakref.WeakKeyDictionary()
+GEOMETRY_ATTRIBUTES = (
+    "Representation",
+    "ObjectPlacement",
+    "VoidsElements",
+    "FillsVoids",
+)
+# inverse attributes of openings and fillings: attribute of the relationship
+# that holds their host element. These are indexed as host ids, not entity ids
+HOST_ATTRIBUTES = {
+    "VoidsElements": "RelatingBuildingElement",
+    "FillsVoids": "RelatingOpeningElement",
+}
+# API commands that can change the geometry of other products than the edited one
+REWIRING_COMMANDS = ("type.", "root.reassign_class", "root.copy_class")
+DECOMPOSITIONS = weakref.WeakKeyDictionary()  # ifcfile: {element id: [child ids]}
+# relationships that make up the decomposition tree: class, parent, children
+DECOMPOSITION_RELATIONS = (
+    ("IfcRelContainedInSpatialStructure", "RelatingStructure", "RelatedElements"),
+    ("IfcRelAggregates", "RelatingObject", "RelatedObjects"),
+    ("IfcRelVoidsElement", "RelatingBuildingElement", "RelatedOpeningElement"),
+    ("IfcRelFillsElement", "RelatingOpeningElement", "RelatedBuildingElement"),
+    ("IfcRelNests", "RelatingObject", "RelatedObjects"),
+    ("IfcRelAdheresToElement", "RelatingElement", "RelatedSurfaceFeatures"),
+)
+# API commands that can change the decomposition tree
+DECOMPOSITION_COMMANDS = (
+    "aggregate.",
+    "spatial.",
+    "nest.",
+    "void.",
+    "feature.",
+    "root.",
+)
+# classes never loaded by default. Furniture and annotations are skipped for
+# now, they can be lazy loaded probably
+EXCLUDED_CLASSES = ("IfcProject", "IfcFurnishingElement", "IfcAnnotation")
+ATTRIBUTE_PLANS = {}  # "SCHEMA.IfcClass": {attribute: (data type, property type, enum)}
 
 
 def create_document(document, filename=None, shapemode=0, strategy=0, silent=False):
@@ -162,6 +210,7 @@ def setup_project(proj, filename, shapemode, silent):
     # https://blenderbim.org/docs-python/autoapi/ifcopenshell/api/owner/create_owner_history/index.html
     # In IFC4, history is optional. What should we do here?
     proj.Proxy.ifcfile = ifcfile
+    register_project(proj, ifcfile)
     add_properties(proj, ifcfile, project, shapemode=shapemode)
     if not "Schema" in proj.PropertiesList:
         proj.addProperty("App::PropertyEnumeration", "Schema", "Base")
@@ -230,18 +279,320 @@ def create_ifcfile():
 def api_run(*args, **kwargs):
     """Runs an IfcOpenShell API call and flags the ifcfile as modified"""
 
-    result = ifcopenshell.api.run(*args, **kwargs)
     # *args are typically command, ifcfile
     if len(args) > 1:
-        ifcfile = args[1]
-        for d in FreeCAD.listDocuments().values():
-            for o in d.Objects:
-                if hasattr(o, "Proxy") and hasattr(o.Proxy, "ifcfile"):
-                    if o.Proxy.ifcfile == ifcfile:
-                        o.Modified = True
+        import ifc_generator  # lazy import
+
+        # background geometry jobs must not read the file while it changes
+        stopped = ifc_generator.stop_jobs(args[1])
+        # find the affected products before their references change
+        products, moved = get_edited_products(args[0], args[1], kwargs)
+        removed = get_removed_product(args[0], kwargs)
+        if moved:
+            import ifc_cache  # lazy import
+
+            placements = ifc_cache.get_placements(args[1], products)
+    result = ifcopenshell.api.run(*args, **kwargs)
+    for batch in BATCHES:
+        batch.calls += 1
+    if len(args) > 1:
+        if args[0].startswith("unit."):
+            SCALES.pop(args[1], None)
+        elif args[0].startswith("context."):
+            CONTEXTS.pop(args[1], None)
+        ORPHANS.pop(args[1], None)
+        if args[0].startswith(DECOMPOSITION_COMMANDS):
+            DECOMPOSITIONS.pop(args[1], None)
+        if args[0].startswith(REWIRING_COMMANDS):
+            USERS.pop(args[1], None)
+        elif removed:
+            update_geometry_users(args[1], [removed])
+        elif products and (
+            has_references(kwargs) or not args[0].startswith("attribute.")
+        ):
+            # only the references of these products can have changed
+            update_geometry_users(args[1], products)
+        if products:
+            import ifc_cache  # lazy import
+
+            if moved:
+                # the cached geometry only needs to be moved
+                ifc_cache.relocate(args[1], placements)
+            else:
+                ifc_cache.invalidate(args[1], products)
+            touch_products(args[1], products, cached=moved)
+        for obj in stopped:
+            # generate again, reusing the geometry generated before stopping
+            obj.Proxy.cached = True
+            obj.touch()
+        project = get_project(args[1])
+        if BATCHES:
+            # the project will be flagged when the batch ends
+            BATCHES[-1].add(project)
+        else:
+            set_modified(project)
     return result
 
 
+def get_geometry_users(ifcfile, entity):
+    """Returns the ids of the products whose representation or placement
+    uses the given entity"""
+
+    if not entity:
+        return set()
+    users, uses = get_geometry_index(ifcfile)
+    products = set(users.get(entity.id(), ()))
+    # openings change the geometry of the elements they void
+    for pid in list(products):
+        products |= uses.get((pid, "VoidsElements"), set())
+    return products
+
+
+def get_host_elements(ifcfile, pid, attrs=HOST_ATTRIBUTES):
+    """Returns the ids of the elements voided by the given opening id, or of
+    the openings filled by the given product id"""
+
+    users, uses = get_geometry_index(ifcfile)
+    hosts = set()
+    for attr in attrs:
+        hosts |= uses.get((pid, attr), set())
+    return hosts
+
+
+def get_geometry_index(ifcfile):
+    """Returns the index of the entities used by the geometry of the products
+    of an ifc file, as a ({entity id: product ids}, {(product id, attribute):
+    entity ids}) tuple. It is built once, then updated as products change"""
+
+    index = USERS.get(ifcfile)
+    if index is None:
+        index = USERS[ifcfile] = ({}, {})
+        update_geometry_users(ifcfile, [p.id() for p in ifcfile.by_type("IfcProduct")])
+    return index
+
+
+def update_geometry_users(ifcfile, products, attrs=GEOMETRY_ATTRIBUTES):
+    """Indexes again the given attributes of the given product ids. Products
+    that have been removed from the file are removed from the index"""
+
+    index = USERS.get(ifcfile)
+    if index is None:
+        # not built yet
+        return
+    users, uses = index
+    for pid in products:
+        try:
+            product = ifcfile[pid]
+        except RuntimeError:
+            product = None
+        for attr in attrs:
+            if attr in HOST_ATTRIBUTES:
+                rels = getattr(product, attr, None) or ()
+                hosts = [getattr(rel, HOST_ATTRIBUTES[attr]) for rel in rels]
+                hosts = {host.id() for host in hosts if host}
+                if hosts:
+                    uses[(pid, attr)] = hosts
+                else:
+                    uses.pop((pid, attr), None)
+                continue
+            for eid in uses.pop((pid, attr), ()):
+                users[eid].discard(pid)
+            value = getattr(product, attr, None)
+            if value:
+                eids = {ent.id() for ent in ifcfile.traverse(value)}
+                uses[(pid, attr)] = eids
+                for eid in eids:
+                    users.setdefault(eid, set()).add(pid)
+
+
+def get_edited_products(command, ifcfile, kwargs):
+    """Returns the ids of the products whose geometry is affected by the
+    given API call, and True if these products are only moved"""
+
+    if command.startswith("void."):
+        # the opening and the element it voids, or the filling and its opening
+        products = set()
+        for key in ("opening", "element"):
+            entity = kwargs.get(key)
+            if isinstance(entity, ifcopenshell.entity_instance):
+                products.add(entity.id())
+                products |= get_host_elements(ifcfile, entity.id())
+        return products, False
+    entity = kwargs.get("product")
+    if not isinstance(entity, ifcopenshell.entity_instance):
+        return set(), False
+    if command == "root.remove_product":
+        # removing an opening changes the elements it voids
+        return get_host_elements(ifcfile, entity.id(), ["VoidsElements"]), False
+    if command == "attribute.edit_attributes":
+        if not entity.is_a("IfcProduct"):
+            return get_geometry_users(ifcfile, entity), False
+        attribs = kwargs.get("attributes", {})
+        products = set()
+        if "ObjectPlacement" in attribs:
+            # objects placed relatively to this one move too
+            products = get_geometry_users(ifcfile, entity.ObjectPlacement)
+            products.add(entity.id())
+        if "Representation" in attribs:
+            products.add(entity.id())
+            return products, False
+        return products, bool(products)
+    elif command == "geometry.edit_object_placement":
+        products = get_geometry_users(ifcfile, entity.ObjectPlacement)
+        return products | {entity.id()}, True
+    elif command.startswith("geometry.") and entity.is_a("IfcProduct"):
+        return {entity.id()}, False
+    return set(), False
+
+
+def get_removed_product(command, kwargs):
+    """Returns the id of the product removed by the given API call, if any"""
+
+    entity = kwargs.get("product")
+    if command == "root.remove_product" and isinstance(
+        entity, ifcopenshell.entity_instance
+    ):
+        if entity.is_a("IfcProduct"):
+            return entity.id()
+    return None
+
+
+def get_decomposition_tree(ifcfile):
+    """Returns a {element id: [child ids]} dictionary of the spatial
+    decomposition, aggregates, openings, fillings, nests and surface features
+    of an ifc file. It is built once, then kept until the tree changes"""
+
+    tree = DECOMPOSITIONS.get(ifcfile)
+    if tree is None:
+        tree = {}
+        for ifcclass, parent, children in DECOMPOSITION_RELATIONS:
+            try:
+                rels = ifcfile.by_type(ifcclass)
+            except RuntimeError:
+                # not in this schema
+                continue
+            for rel in rels:
+                related = getattr(rel, children)
+                if not isinstance(related, (list, tuple)):
+                    related = [related]
+                relating = getattr(rel, parent)
+                if relating and related:
+                    ids = tree.setdefault(relating.id(), [])
+                    ids.extend([r.id() for r in related if r])
+        DECOMPOSITIONS[ifcfile] = tree
+    return tree
+
+
+def has_references(kwargs):
+    """Tells if the attributes edited by an API call reference other entities"""
+
+    for value in kwargs.get("attributes", {}).values():
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        for v in value:
+            if isinstance(v, ifcopenshell.entity_instance):
+                return True
+    return False
+
+
+def touch_products(ifcfile, products, cached=False):
+    """Touches the objects that show the given product ids. Products that
+    have no object of their own are shown by the object of their parent.
+    If cached is True, the objects can reuse their cached geometry"""
+
+    objs = []
+    for pid in products:
+        try:
+            element = ifcfile[pid]
+        except RuntimeError:
+            # removed by the API call
+            continue
+        obj = get_object(element)
+        while not obj and element:
+            parent = ifcopenshell.util.element.get_aggregate(
+                element
+            ) or ifcopenshell.util.element.get_container(element)
+            if not parent:
+                # openings are shown by the element they void
+                hosts = get_host_elements(ifcfile, element.id())
+                parent = ifcfile[min(hosts)] if hosts else None
+            element = parent
+            if element:
+                obj = get_object(element)
+        if obj and obj not in objs:
+            objs.append(obj)
+    for obj in objs:
+        if cached and hasattr(obj, "Proxy"):
+            obj.Proxy.cached = True
+        obj.touch()
+
+
+def set_modified(project):
+    """Flags a project as modified, if it is not yet"""
+
+    if hasattr(project, "Modified") and not project.Modified:
+        project.Modified = True
+
+
+class api_batch:
+    """Groups several api_run calls, as a context manager or a decorator.
+    The affected projects are flagged as modified only once, when the
+    outermost batch ends:
+
+    with ifc_tools.api_batch() as batch:
+        ...
+    print(batch.calls, "API calls")
+    """
+
+    def __init__(self, label="IFC batch"):
+        self.label = label
+        self.calls = 0
+        self.projects = []
+        self.duration = 0
+
+    def __enter__(self):
+        self.calls = 0
+        self.projects = []
+        self.stime = time.time()
+        BATCHES.append(self)
+        return self
+
+    def __call__(self, func):
+        """Used as a decorator. Each call gets its own batch, so reentrant
+        calls don't reset the state of the enclosing one"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with api_batch(self.label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def __exit__(self, *exc):
+        BATCHES.remove(self)
+        if BATCHES:
+            # nested batch: hand the projects over to the enclosing batch
+            for project in self.projects:
+                BATCHES[-1].add(project)
+        else:
+            for project in self.projects:
+                set_modified(project)
+        self.duration = time.time() - self.stime
+        if self.calls:
+            FreeCAD.Console.PrintLog(
+                "IFC: {}: {} API calls in {:.2f}s\n".format(
+                    self.label, self.calls, self.duration
+                )
+            )
+        return False
+
+    def add(self, project):
+        """Adds a project to be flagged as modified when the batch ends"""
+
+        if project is not None and project not in self.projects:
+            self.projects.append(project)
+
+
 def create_object(ifcentity, document, ifcfile, shapemode=0):
     """Creates a FreeCAD object from an IFC entity"""
 
@@ -262,6 +613,55 @@ def create_object(ifcentity, document, ifcfile, shapemode=0):
     return obj
 
 
+def create_objects(elements, parent, ifcfile=None, shapemode=None):
+    """Creates FreeCAD objects for all the given IFC entities at once and adds
+    them to the given parent object, if any. Recomputes and view updates are
+    suspended meanwhile"""
+
+    if not elements:
+        return []
+    stime = time.time()
+    doc = getattr(parent, "Document", parent)
+    if not ifcfile:
+        ifcfile = get_ifcfile(parent)
+    if shapemode is None:
+        shapemode = getattr(parent, "ShapeMode", "Coin")
+    with bulk_mode(doc):
+        objs = [create_object(e, doc, ifcfile, shapemode) for e in elements]
+        if isinstance(parent, FreeCAD.DocumentObject):
+            parent.Proxy.addObjects(parent, objs)
+    FreeCAD.Console.PrintLog(
+        "IFC: Created {} objects in {:.2f}s\n".format(len(objs), time.time() - stime)
+    )
+    return objs
+
+
+class bulk_mode:
+    """Context manager that suspends recomputes and GUI updates of a document
+    while many objects are created or removed"""
+
+    def __init__(self, document):
+        self.document = getattr(document, "Document", document)
+        self.window = None
+
+    def __enter__(self):
+        self.frozen = self.document.RecomputesFrozen
+        self.document.RecomputesFrozen = True
+        if FreeCAD.GuiUp:
+            import FreeCADGui
+
+            self.window = FreeCADGui.getMainWindow()
+            self.updates = self.window.updatesEnabled()
+            self.window.setUpdatesEnabled(False)
+        return self
+
+    def __exit__(self, *exc):
+        self.document.RecomputesFrozen = self.frozen
+        if self.window:
+            self.window.setUpdatesEnabled(self.updates)
+        return False
+
+
 def create_children(
     obj,
     ifcfile=None,
@@ -278,26 +678,25 @@ def create_children(
             return proj.OutListRecursive
         elif hasattr(proj, "Objects"):
             return proj.Objects
+        return []
 
-    def create_child(parent, element):
-        subresult = []
+    def create_batch(parent, elements):
         # do not create if a child with same stepid already exists
-        if not element.id() in [
-            getattr(c, "StepId", 0) for c in get_parent_objects(parent)
-        ]:
-            doc = getattr(parent, "Document", parent)
-            mode = getattr(parent, "ShapeMode", "Coin")
-            child = create_object(element, doc, ifcfile, mode)
-            subresult.append(child)
-            if isinstance(parent, FreeCAD.DocumentObject):
-                parent.Proxy.addObject(parent, child)
+        batch = []
+        for element in elements:
+            if element.id() not in existing:
+                existing.add(element.id())
+                batch.append(element)
+        elements = batch
+        children = create_objects(elements, parent, ifcfile)
+        subresult = list(children)
+        for element, child in zip(elements, children):
             if element.is_a("IfcSite"):
                 # force-create contained buildings too if we just created a site
                 buildings = [
                     o for o in get_children(child, ifcfile) if o.is_a("IfcBuilding")
                 ]
-                for building in buildings:
-                    subresult.extend(create_child(child, building))
+                subresult.extend(create_batch(child, buildings))
             elif element.is_a("IfcOpeningElement"):
                 # force-create contained windows too if we just created an opening
                 windows = [
@@ -305,24 +704,23 @@ def create_children(
                     for o in get_children(child, ifcfile)
                     if o.is_a() in ("IfcWindow", "IfcDoor")
                 ]
-                for window in windows:
-                    subresult.extend(create_child(child, window))
+                subresult.extend(create_batch(child, windows))
             if recursive:
-                subresult.extend(
-                    create_children(
-                        child, ifcfile, recursive, only_structure, assemblies
-                    )
-                )
+                subresult.extend(expand_children(child))
+        return subresult
+
+    def expand_children(parent, expand=False):
+        children = get_children(parent, ifcfile, only_structure, assemblies, expand)
+        subresult = create_batch(parent, children)
+        assign_groups(children)
         return subresult
 
     if not ifcfile:
         ifcfile = get_ifcfile(obj)
-    result = []
-    children = get_children(obj, ifcfile, only_structure, assemblies, expand)
-    for child in children:
-        result.extend(create_child(obj, child))
-    assign_groups(children)
-    return result
+    # StepIds of all the objects already present in the project, updated as we go
+    existing = set([getattr(c, "StepId", 0) for c in get_parent_objects(obj)])
+    with bulk_mode(obj):
+        return expand_children(obj, expand)
 
 
 def assign_groups(children):
@@ -373,17 +771,130 @@ def get_children(
 def get_object(element, document=None):
     """Returns the object that references this element, if any"""
 
-    if document:
-        ldocs = {"document": document}
-    else:
-        ldocs = FreeCAD.listDocuments()
-    for n, d in ldocs.items():
-        for obj in d.Objects:
-            if hasattr(obj, "StepId"):
-                if obj.StepId == element.id():
-                    if get_ifc_element(obj) == element:
-                        return obj
-    return None
+    ifcfile = get_element_file(element)
+    if ifcfile is None:
+        return None
+    obj = get_registry(ifcfile)["StepId"].get(element.id())
+    if obj and document and obj.Document != document:
+        return None
+    return obj
+
+
+def get_object_by_guid(guid, ifcfile):
+    """Returns the object that references the element with the given GlobalId, if any"""
+
+    return get_registry(ifcfile)["GlobalId"].get(guid)
+
+
+def get_element_file(element):
+    """Returns the ifcfile an element belongs to"""
+
+    # IfcOpenShell keeps a reference to the file in the wrapped data
+    ifcfile = getattr(element.wrapped_data, "file", None)
+    if ifcfile is None:
+        for f in REGISTRY.keys():
+            try:
+                if f.by_id(element.id()) == element:
+                    return f
+            except RuntimeError:
+                pass
+    return ifcfile
+
+
+def get_registry(ifcfile):
+    """Returns the StepId and GlobalId lookup tables of the objects that use the
+    given ifcfile. The tables are built on first use"""
+
+    registry = REGISTRY.get(ifcfile)
+    if registry is None:
+        registry = {"StepId": {}, "GlobalId": {}}
+        REGISTRY[ifcfile] = registry
+        project = get_project(ifcfile)
+        if isinstance(project, FreeCAD.DocumentObject):
+            objs = [project] + project.OutListRecursive
+            # objects outside the project tree, such as orphans
+            names = set([o.Name for o in objs])
+            for obj in project.Document.Objects:
+                if obj.Name not in names and uses_file(obj, ifcfile):
+                    objs.append(obj)
+        elif project:
+            objs = project.Objects
+        else:
+            objs = []
+        for obj in objs:
+            register_object(obj, ifcfile)
+    return registry
+
+
+def uses_file(obj, ifcfile):
+    """Tells if an object references an element of the given ifcfile. Objects
+    that belong to no project are matched by GlobalId"""
+
+    if not getattr(obj, "StepId", None):
+        return False
+    objfile = get_ifcfile(obj)
+    if objfile:
+        return objfile == ifcfile
+    try:
+        element = ifcfile.by_id(obj.StepId)
+    except RuntimeError:
+        return False
+    guid = getattr(obj, "GlobalId", None)
+    return bool(guid) and getattr(element, "GlobalId", None) == guid
+
+
+def register_object(obj, ifcfile=None):
+    """Adds an object to the lookup tables of its ifcfile"""
+
+    if not isinstance(obj, FreeCAD.DocumentObject):
+        return
+    stepid = getattr(obj, "StepId", None)
+    if not stepid:
+        return
+    if not ifcfile:
+        ifcfile = get_ifcfile(obj)
+        if not ifcfile:
+            return
+    registry = get_registry(ifcfile)
+    registry["StepId"][stepid] = obj
+    guid = getattr(obj, "GlobalId", None)
+    if guid:
+        registry["GlobalId"][guid] = obj
+
+
+def unregister_object(obj):
+    """Removes an object from all lookup tables"""
+
+    stepid = getattr(obj, "StepId", None)
+    guid = getattr(obj, "GlobalId", None)
+    for registry in REGISTRY.values():
+        if stepid and registry["StepId"].get(stepid) == obj:
+            del registry["StepId"][stepid]
+        if guid and registry["GlobalId"].get(guid) == obj:
+            del registry["GlobalId"][guid]
+
+
+def clear_registry(document=None):
+    """Discards the lookup tables of the ifcfiles used in the given document, or
+    all of them. They will be rebuilt on next use"""
+
+    for ifcfile in list(REGISTRY.keys()):
+        if document:
+            project = PROJECTS.get(ifcfile)
+            if getattr(project, "Document", project) != document:
+                continue
+        del REGISTRY[ifcfile]
+
+
+def migrate_objects(objs, migration_table, ifcfile):
+    """Updates the StepIds of the given objects after a schema migration"""
+
+    objs = {getattr(o, "StepId", None): o for o in objs}
+    for old_id, new_id in migration_table.items():
+        child = objs.get(old_id)
+        if child:
+            child.StepId = new_id
+    REGISTRY.pop(ifcfile, None)
 
 
 def get_ifcfile(obj):
@@ -402,6 +913,7 @@ def get_ifcfile(obj):
                         project.Proxy = ifc_objects.document_object()
             if getattr(project, "Proxy", None):
                 project.Proxy.ifcfile = ifcfile
+                register_project(project, ifcfile)
             return ifcfile
     return None
 
@@ -412,12 +924,12 @@ def get_project(obj):
 
     proj_types = ("IfcProject", "IfcProjectLibrary")
     if isinstance(obj, ifcopenshell.file):
-        for d in FreeCAD.listDocuments().values():
-            for o in d.Objects:
-                if hasattr(o, "Proxy") and hasattr(o.Proxy, "ifcfile"):
-                    if o.Proxy.ifcfile == obj:
-                        return o
-        return None
+        project = PROJECTS.get(obj)
+        if project is None:
+            project = find_project(obj)
+            if project is not None:
+                register_project(project, obj)
+        return project
     if isinstance(obj, ifcopenshell.entity_instance):
         obj = get_object(obj)
     if hasattr(obj, "IfcFilePath"):
@@ -433,6 +945,34 @@ def get_project(obj):
     return None
 
 
+def find_project(ifcfile):
+    """Searches all open documents for the project that owns the given ifcfile"""
+
+    for d in FreeCAD.listDocuments().values():
+        if getattr(getattr(d, "Proxy", None), "ifcfile", None) == ifcfile:
+            return d
+        for o in d.Objects:
+            if hasattr(o, "Proxy") and hasattr(o.Proxy, "ifcfile"):
+                if o.Proxy.ifcfile == ifcfile:
+                    return o
+    return None
+
+
+def register_project(project, ifcfile):
+    """Records the given project object or document as owner of the given ifcfile"""
+
+    PROJECTS[ifcfile] = project
+
+
+def unregister_project(project):
+    """Removes the given project object or document from the owners registry"""
+
+    for ifcfile, proj in list(PROJECTS.items()):
+        if proj == project:
+            del PROJECTS[ifcfile]
+            REGISTRY.pop(ifcfile, None)
+
+
 def can_expand(obj, ifcfile=None):
     """Returns True if this object can have any more child extracted"""
 
@@ -512,7 +1052,7 @@ def add_properties(
         obj.ShapeMode = shapemode
         if not obj.isDerivedFrom("Part::Feature"):
             obj.setPropertyStatus("ShapeMode", "Hidden")
-    attr_defs = ifcentity.wrapped_data.declaration().as_entity().all_attributes()
+    plan = get_attribute_plan(ifcentity)
     try:
         info_ifcentity = ifcentity.get_info()
     except:
@@ -527,12 +1067,7 @@ def add_properties(
             continue
         if short and attr not in ("Class", "StepId"):
             continue
-        attr_def = next((a for a in attr_defs if a.name() == attr), None)
-        data_type = (
-            ifcopenshell.util.attribute.get_primitive_type(attr_def)
-            if attr_def
-            else None
-        )
+        data_type, ptype, items = plan.get(attr, (None, None, None))
         if attr == "Class":
             # main enum property, not saved to file
             if attr not in obj.PropertiesList:
@@ -542,14 +1077,15 @@ def add_properties(
             # class, then we add the sibling classes
             setattr(obj, attr, [value])
             setattr(obj, attr, value)
-            setattr(obj, attr, get_ifc_classes(obj, value))
+            setattr(obj, attr, get_ifc_classes(obj, value, ifcfile))
             # companion hidden propertym that gets saved to file
             if "IfcClass" not in obj.PropertiesList:
                 obj.addProperty("App::PropertyString", "IfcClass", "IFC")
                 obj.setPropertyStatus("IfcClass", "Hidden")
             setattr(obj, "IfcClass", value)
-        elif attr_def and "IfcLengthMeasure" in str(attr_def.type_of_attribute()):
-            obj.addProperty("App::PropertyDistance", attr, "IFC")
+        elif ptype == "App::PropertyDistance":
+            if attr not in obj.PropertiesList:
+                obj.addProperty(ptype, attr, "IFC")
             if value:
                 setattr(obj, attr, value * (1 / get_scale(ifcfile)))
         elif isinstance(value, int):
@@ -588,8 +1124,7 @@ def add_properties(
                     # setattr(obj, attr, nvalue)
         elif data_type == "enum":
             if attr not in obj.PropertiesList:
-                obj.addProperty("App::PropertyEnumeration", attr, "IFC")
-            items = ifcopenshell.util.attribute.get_enum_items(attr_def)
+                obj.addProperty(ptype, attr, "IFC")
             if value not in items:
                 for v in ("UNDEFINED", "NOTDEFINED", "USERDEFINED"):
                     if v in items:
@@ -610,6 +1145,31 @@ def add_properties(
     # link Label2 and Description
     if "Description" in obj.PropertiesList and hasattr(obj, "setExpression"):
         obj.setExpression("Label2", "Description")
+    register_object(obj, ifcfile)
+
+
+def get_attribute_plan(ifcentity):
+    """Returns, for each attribute of the class of the given entity, its primitive
+    data type, the FreeCAD property type to use when it can be decided from the
+    schema alone, and its enumeration items. Plans are computed once per class"""
+
+    key = ifcentity.is_a(True)  # includes the schema name
+    plan = ATTRIBUTE_PLANS.get(key)
+    if plan is None:
+        plan = {}
+        declaration = ifcentity.wrapped_data.declaration().as_entity()
+        for attr_def in declaration.all_attributes():
+            data_type = ifcopenshell.util.attribute.get_primitive_type(attr_def)
+            ptype = None
+            items = None
+            if "IfcLengthMeasure" in str(attr_def.type_of_attribute()):
+                ptype = "App::PropertyDistance"
+            elif data_type == "enum":
+                ptype = "App::PropertyEnumeration"
+                items = ifcopenshell.util.attribute.get_enum_items(attr_def)
+            plan[attr_def.name()] = (data_type, ptype, items)
+        ATTRIBUTE_PLANS[key] = plan
+    return plan
 
 
 def remove_unused_properties(obj):
@@ -625,18 +1185,26 @@ def remove_unused_properties(obj):
                 obj.removeProperty(prop)
 
 
-def get_ifc_classes(obj, baseclass):
+def get_ifc_classes(obj, baseclass, ifcfile=None):
     """Returns a list of sibling classes from a given FreeCAD object"""
 
-    # this function can become pure IFC
-
     if baseclass in ("IfcProject", "IfcProjectLibrary"):
         return ("IfcProject", "IfcProjectLibrary")
-    ifcfile = get_ifcfile(obj)
+    if not ifcfile:
+        ifcfile = get_ifcfile(obj)
     if not ifcfile:
         return [baseclass]
-    classes = []
     schema = ifcfile.wrapped_data.schema_name()
+    return list(get_sibling_classes(schema, baseclass))
+
+
+@functools.lru_cache(maxsize=1024)
+def get_sibling_classes(schema, baseclass):
+    """Returns a tuple of sibling classes of a class in the given schema"""
+
+    # This function can become pure IFC
+
+    classes = []
     schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema)
     declaration = schema.declaration_by_name(baseclass)
     if "StandardCase" in baseclass:
@@ -650,7 +1218,7 @@ def get_ifc_classes(obj, baseclass):
     classes.extend([sub.name() for sub in declaration.subtypes()])
     if baseclass not in classes:
         classes.append(baseclass)
-    return classes
+    return tuple(classes)
 
 
 def get_ifc_element(obj, ifcfile=None):
@@ -681,9 +1249,11 @@ def filter_elements(elements, ifcfile, expand=True, spaces=False, assemblies=Tru
     # gather decomposition if needed
     if not isinstance(elements, (list, tuple)):
         elements = [elements]
+    schema = ifcfile.wrapped_data.schema_name()
     openings = False
-    if assemblies and any([e.is_a("IfcOpeningElement") for e in elements]):
-        openings = True
+    if assemblies:
+        opening_filter = get_class_filter(schema, include=("IfcOpeningElement",))
+        openings = any(opening_filter.accepts(e) for e in elements)
     if expand and (len(elements) == 1):
         elem = elements[0]
         if elem.is_a("IfcSpace"):
@@ -707,19 +1277,77 @@ def filter_elements(elements, ifcfile, expand=True, spaces=False, assemblies=Tru
                     # the Polyline is the wall axis
                     # see https://github.com/yorikvanhavre/FreeCAD-NativeIFC/issues/28
                     elements = ifcopenshell.util.element.get_decomposition(elem)
+    exclude = EXCLUDED_CLASSES
     if not openings:
         # Never load feature elements by default, they can be lazy loaded
-        elements = [e for e in elements if not e.is_a("IfcFeatureElement")]
+        exclude += ("IfcFeatureElement",)
     # do load spaces when required, otherwise skip computing their shapes
     if not spaces:
-        elements = [e for e in elements if not e.is_a("IfcSpace")]
-    # skip projects
-    elements = [e for e in elements if not e.is_a("IfcProject")]
-    # skip furniture for now, they can be lazy loaded probably
-    elements = [e for e in elements if not e.is_a("IfcFurnishingElement")]
-    # skip annotations for now
-    elements = [e for e in elements if not e.is_a("IfcAnnotation")]
-    return elements
+        exclude += ("IfcSpace",)
+    return get_class_filter(schema, exclude).filter(elements)
+
+
+class class_filter:
+    """Filters IFC elements by class in a single pass. The included and excluded
+    classes are expanded to all their subtypes once, so testing an element only
+    costs one set lookup"""
+
+    def __init__(self, schema, exclude=(), include=()):
+        self.exclude = get_subclasses(schema, tuple(exclude))
+        self.include = get_subclasses(schema, tuple(include)) if include else None
+
+    def accepts(self, element):
+        """Tells if the given element passes this filter"""
+
+        ifcclass = element.is_a()
+        if self.include is not None and ifcclass not in self.include:
+            return False
+        return ifcclass not in self.exclude
+
+    def filter(self, elements, exclude_ids=None):
+        """Returns the elements from the given list that pass this filter
+        and whose id is not in exclude_ids"""
+
+        exclude_ids = set(exclude_ids) if exclude_ids else ()
+        return [
+            e for e in elements if self.accepts(e) and e.id() not in exclude_ids
+        ]
+
+
+@functools.lru_cache(maxsize=256)
+def get_class_filter(schema, exclude=(), include=()):
+    """Returns a class_filter for the given schema, excluded and included classes"""
+
+    return class_filter(schema, exclude, include)
+
+
+@functools.lru_cache(maxsize=256)
+def get_subclasses(schema, classes):
+    """Returns the names of the given classes and all their subtypes in the
+    given schema. Classes that don't exist in the schema are ignored"""
+
+    # This function can become pure IFC
+
+    schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema)
+    result = set()
+    for ifcclass in classes:
+        try:
+            declarations = [schema.declaration_by_name(ifcclass)]
+        except Exception:
+            continue
+        while declarations:
+            declaration = declarations.pop()
+            result.add(declaration.name())
+            declarations.extend(declaration.subtypes())
+    return frozenset(result)
+
+
+def get_schema(element):
+    """Returns the schema name of the given element"""
+
+    # This function can become pure IFC
+
+    return element.is_a(True).split(".")[0]
 
 
 def set_attribute(ifcfile, element, attribute, value):
@@ -770,35 +1398,51 @@ def set_attribute(ifcfile, element, attribute, value):
 
 
 def set_colors(obj, colors):
-    """Sets the given colors to an object"""
+    """Sets the given colors to an object. If all the colors are the same,
+    only one color is set for the whole object"""
 
     if FreeCAD.GuiUp and colors:
-        # ifcopenshell issues (-1,-1,-1) colors if not set
-        if isinstance(colors[0], (tuple, list)):
-            colors = [tuple([abs(d) for d in c]) for c in colors]
-        else:
-            colors = [abs(c) for c in colors]
+        if not isinstance(colors[0], (tuple, list)):
+            colors = [colors]
+        palette, indices = get_palette(colors)
         if hasattr(obj.ViewObject, "ShapeColor"):
-            if isinstance(colors[0], (tuple, list)):
-                obj.ViewObject.ShapeColor = colors[0][:3]
-                if len(colors[0]) > 3:
-                    obj.ViewObject.Transparency = int(colors[0][3] * 100)
-            else:
-                obj.ViewObject.ShapeColor = colors[:3]
-                if len(colors) > 3:
-                    obj.ViewObject.Transparency = int(colors[3] * 100)
+            obj.ViewObject.ShapeColor = palette[0][:3]
+            if len(palette[0]) > 3:
+                obj.ViewObject.Transparency = int(palette[0][3] * 100)
         if hasattr(obj.ViewObject, "DiffuseColor"):
             # strip out transparency value because it currently gives ugly
             # results in FreeCAD when combining transparent and non-transparent objects
-            if all([len(c) > 3 and c[3] != 0 for c in colors]):
-                obj.ViewObject.DiffuseColor = colors
+            if not all([len(c) > 3 and c[3] != 0 for c in palette]):
+                palette = [c[:3] for c in palette]
+            if len(palette) == 1:
+                obj.ViewObject.DiffuseColor = palette
             else:
-                obj.ViewObject.DiffuseColor = [c[:3] for c in colors]
+                obj.ViewObject.DiffuseColor = [palette[i] for i in indices]
+
+
+def get_palette(colors):
+    """Returns a list of the distinct colors found in the given list, and the
+    index in that list of each of the given colors"""
+
+    palette = []
+    indices = []
+    entries = {}
+    for color in colors:
+        color = tuple(color)
+        index = entries.get(color)
+        if index is None:
+            index = entries[color] = len(palette)
+            # ifcopenshell issues (-1,-1,-1) colors if not set
+            palette.append(tuple([abs(d) for d in color]))
+        indices.append(index)
+    return palette, indices
 
 
 def get_body_context_ids(ifcfile):
     # This function can become pure IFC
 
+    if ifcfile in CONTEXTS:
+        return CONTEXTS[ifcfile]
     # Facetation is to accommodate broken Revit files
     # See https://forums.buildingsmart.org/t/suggestions-on-how-to-improve-clarity\
     # -of-representation-context-usage-in-documentation/3663/6?u=moult
@@ -818,6 +1462,7 @@ def get_body_context_ids(ifcfile):
             if c.ContextType == "Model"
         ]
     )
+    CONTEXTS[ifcfile] = body_contexts
     return body_contexts
 
 
@@ -867,9 +1512,13 @@ def get_ios_matrix(m):
 def get_scale(ifcfile):
     """Returns the scale factor to convert any file length to mm"""
 
-    scale = ifcopenshell.util.unit.calculate_unit_scale(ifcfile)
-    # the above lines yields meter -> file unit scale factor. We need mm
-    return 0.001 / scale
+    scale = SCALES.get(ifcfile)
+    if scale is None:
+        scale = ifcopenshell.util.unit.calculate_unit_scale(ifcfile)
+        # the above lines yields meter -> file unit scale factor. We need mm
+        scale = 0.001 / scale
+        SCALES[ifcfile] = scale
+    return scale
 
 
 def set_placement(obj):
@@ -1236,9 +1885,12 @@ def remove_ifc_element(obj):
 
     # This function can become pure IFC
 
+    import ifc_cache  # lazy import
+
     ifcfile = get_ifcfile(obj)
     element = get_ifc_element(obj)
     if ifcfile and element:
+        ifc_cache.invalidate(ifcfile, [element.id()])
         api_run("root.remove_product", ifcfile, product=element)
         return True
     return False
@@ -1247,13 +1899,28 @@ def remove_ifc_element(obj):
 def get_orphan_elements(ifcfile):
     """returns a list of orphan products in an ifcfile"""
 
-    products = ifcfile.by_type("IfcElement")
-    products = [p for p in products if not p.Decomposes]
-    products = [p for p in products if not p.ContainedInStructure]
-    products = [
-        p for p in products if not hasattr(p, "VoidsElements") or not p.VoidsElements
-    ]
-    return products
+    # This function can become pure IFC
+
+    orphans = ORPHANS.get(ifcfile)
+    if orphans is None:
+        # gather all related elements in one pass over the relationships,
+        # instead of querying the inverse attributes of each element
+        if ifcfile.wrapped_data.schema_name() == "IFC2X3":
+            # in IFC2X3, Decomposes also includes nesting relationships
+            decompositions = ifcfile.by_type("IfcRelDecomposes")
+        else:
+            decompositions = ifcfile.by_type("IfcRelAggregates")
+        related = set()
+        for rel in decompositions:
+            related.update([e.id() for e in rel.RelatedObjects])
+        for rel in ifcfile.by_type("IfcRelContainedInSpatialStructure"):
+            related.update([e.id() for e in rel.RelatedElements])
+        for rel in ifcfile.by_type("IfcRelVoidsElement"):
+            related.add(rel.RelatedOpeningElement.id())
+        products = ifcfile.by_type("IfcElement")
+        orphans = [p.id() for p in products if p.id() not in related]
+        ORPHANS[ifcfile] = orphans
+    return [ifcfile[i] for i in orphans]
 
 
 def get_group(project, name):
@@ -1294,29 +1961,47 @@ def load_orphans(obj):
     ifcfile = get_ifcfile(obj)
     shapemode = obj.ShapeMode
     elements = get_orphan_elements(ifcfile)
-    for element in elements:
-        create_object(element, doc, ifcfile, shapemode)
+    create_objects(elements, doc, ifcfile, shapemode)
 
 
 def remove_tree(objs):
     """Removes all given objects and their children, if not used by others"""
 
+    remove_objects(get_owned_tree(objs))
+
+
+def get_owned_tree(objs, owners=[]):
+    """Returns the given objects and their descendants that are not used by
+    any object outside of them. Objects given as owners may use them too, but
+    are not part of the returned list"""
+
+    names = set([o.Name for o in owners])
+    tree = []
+    todo = list(reversed(objs))
+    while todo:
+        obj = todo.pop()
+        if obj.Name not in names:
+            names.add(obj.Name)
+            tree.append(obj)
+            todo.extend(reversed(obj.OutList))
+    return [o for o in tree if all([p.Name in names for p in o.InList])]
+
+
+def remove_objects(objs, nodelete=False):
+    """Removes the given objects from their document in one operation. If
+    nodelete is True, the corresponding IFC entities are kept in the file"""
+
     if not objs:
         return
     doc = objs[0].Document
-    nobjs = objs
-    for obj in objs:
-        for child in obj.OutListRecursive:
-            if not child in nobjs:
-                nobjs.append(child)
-    deletelist = []
-    for obj in nobjs:
-        for par in obj.InList:
-            if par not in nobjs:
-                break
-        else:
-            deletelist.append(obj.Name)
-    for n in deletelist:
-        doc.removeObject(n)
-
-
+    names = [o.Name for o in objs]
+    with bulk_mode(doc):
+        if nodelete:
+            for obj in objs:
+                if hasattr(obj, "Proxy"):
+                    # this prevents to trigger the deletion inside the IFC file
+                    obj.Proxy.nodelete = True
+        # remove children first, so parents don't need to update their links
+        for name in reversed(names):
+            if doc.getObject(name):
+                doc.removeObject(name)
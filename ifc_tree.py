@@ -109,23 +109,24 @@ def show_geometry_tree(element):
         obj = ifc_tools.get_object(element)
         ifcfile = ifc_tools.get_ifcfile(obj)
         modified = False
-        for prop in props:
-            elt = ifcfile[int(prop[0])]
-            attrib = prop[1]
-            if attrib not in dir(elt):
-                print("DEBUG: Unknown attribute:", attrib)
-                continue
-            value = prop[3]
-            if isfloat(getattr(elt, attrib)):
-                try:
-                    value = float(value)
-                except:
-                    print("DEBUG: wrong value for", attrib, ":", value)
+        with ifc_tools.api_batch("Geometry tree edit"):
+            for prop in props:
+                elt = ifcfile[int(prop[0])]
+                attrib = prop[1]
+                if attrib not in dir(elt):
+                    print("DEBUG: Unknown attribute:", attrib)
                     continue
-            ifc_tools.set_attribute(ifcfile, elt, attrib, value)
-            modified = True
+                value = prop[3]
+                if isfloat(getattr(elt, attrib)):
+                    try:
+                        value = float(value)
+                    except:
+                        print("DEBUG: wrong value for", attrib, ":", value)
+                        continue
+                ifc_tools.set_attribute(ifcfile, elt, attrib, value)
+                modified = True
         if modified:
-            obj.touch()
+            # the affected objects have been touched by api_run
             proj = ifc_tools.get_project(obj)
             proj.Modified = True
             obj.Document.recompute()
@@ -65,9 +65,16 @@ class ifc_vp_object:
             colors = []
             for child in obj.Group:
                 if hasattr(child.ViewObject, "DiffuseColor"):
-                    colors.extend(child.ViewObject.DiffuseColor)
+                    dcolors = child.ViewObject.DiffuseColor
+                    if len(dcolors) == 1 and hasattr(child, "Shape"):
+                        # a single color applies to all the faces of the child
+                        dcolors = dcolors * (child.Shape.countElement("Face") or 1)
+                    colors.extend(dcolors)
             if colors:
-                obj.ViewObject.DiffuseColor = colors
+                if len(set(colors)) == 1:
+                    colors = colors[:1]
+                if colors != obj.ViewObject.DiffuseColor:
+                    obj.ViewObject.DiffuseColor = colors
 
     def getIcon(self):
         path = os.path.dirname(os.path.dirname(__file__))
@@ -203,26 +210,15 @@ class ifc_vp_object:
     def collapseChildren(self):
         """Collapses the children of this object"""
 
-        objs = self.Object.Group
-        for o in objs:
-            objs.extend(self.getOwnChildren(o))
-        for o in objs:
-            if hasattr(o, "Proxy"):
-                # this prevents to trigger the deletion inside the IFC file
-                o.Proxy.nodelete = True
-        names = [o.Name for o in objs]
-        for name in names:
-            self.Object.Document.removeObject(name)
-        self.Object.Document.recompute()
+        import ifc_tools  # lazy import
 
-    def getOwnChildren(self, obj):
-        """Recursively gets the children only used by this object"""
-        children = []
-        for child in obj.OutList:
-            if len(child.InList) == 1 and child.InList[1] == obj:
-                children.append(child)
-                children.extend(self.getOwnChildren(child))
-        return children
+        group = self.Object.Group
+        names = set([o.Name for o in group])
+        objs = ifc_tools.get_owned_tree(group, [self.Object])
+        # the children themselves are always collapsed
+        objs = group + [o for o in objs if o.Name not in names]
+        ifc_tools.remove_objects(objs, nodelete=True)
+        self.Object.Document.recompute()
 
     def switchShape(self):
         """Switch this object between shape and coin"""
@@ -0,0 +1,98 @@
+# ***************************************************************************
+# *                                                                         *
+# *   Copyright (c) 2022 Yorik van Havre <yorik@uncreated.net>              *
+# *                                                                         *
+# *   This program is free software; you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License (GPL)            *
+# *   as published by the Free Software Foundation; either version 3 of     *
+# *   the License, or (at your option) any later version.                   *
+# *   for detail see the LICENCE text file.                                 *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU Library General Public     *
+# *   License along with this program; if not, write to the Free Software   *
+# *   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  *
+# *   USA                                                                   *
+# *                                                                         *
+# ***************************************************************************
+
+
+"""This module contains the functions run by worker processes. It only imports
+ifcopenshell at module level, so it can be loaded by a plain Python interpreter
+outside of FreeCAD"""
+
+
+import ifcopenshell
+import ifcopenshell.geom
+
+FILE = None  # the IFC file opened by this worker process
+
+
+def open_file(path):
+    """Opens the IFC file at the given path. Runs once when the worker process
+    starts, so the file is not parsed again for each chunk of elements"""
+
+    global FILE
+    FILE = ifcopenshell.open(path)
+
+
+def generate_breps(ids, contexts, openings, scale):
+    """Generates the BREP data of the given element ids of the IFC file opened
+    by this worker process. Returns a list of (id, brep, matrix, styles,
+    transformed) tuples. If the FreeCAD Part module can be imported here, the
+    returned BREP data is already scaled and placed, and transformed is True"""
+
+    try:
+        import FreeCAD
+        import Part
+    except ImportError:
+        Part = None
+    ifcfile = FILE
+    settings = ifcopenshell.geom.settings()
+    settings.set(settings.DISABLE_TRIANGULATION, True)
+    settings.set(settings.USE_BREP_DATA, True)
+    settings.set(settings.SEW_SHELLS, True)
+    if not openings:
+        settings.set(settings.DISABLE_OPENING_SUBTRACTIONS, True)
+    if contexts:
+        settings.set_context_ids(contexts)
+    elements = [ifcfile[i] for i in ids]
+    iterator = ifcopenshell.geom.iterator(settings, ifcfile, 1, include=elements)
+    results = []
+    if not iterator.initialize():
+        return results
+    while True:
+        item = iterator.get()
+        if item:
+            results.append(get_brep(item, scale, Part))
+        if not iterator.next():
+            break
+    return results
+
+
+def get_brep(item, scale, Part=None):
+    """Returns an (id, brep, matrix, styles, transformed) tuple from an item
+    of a geometry iterator. The BREP data is transformed if Part is given"""
+
+    brep = item.geometry.brep_data
+    matrix = tuple(item.transformation.matrix.data)
+    if Part:
+        import FreeCAD
+
+        shape = Part.Shape()
+        shape.importBrepFromString(brep, False)
+        shape.scale(scale)
+        # same as ifc_tools.get_freecad_matrix
+        rows = []
+        for i in range(3):
+            row = list(matrix[i::3])
+            row[-1] *= scale
+            rows.extend(row)
+        shape.transformShape(FreeCAD.Matrix(*rows))
+        brep = shape.exportBrepToString()
+    styles = tuple(item.geometry.surface_styles)
+    return item.id, brep, matrix, styles, bool(Part)